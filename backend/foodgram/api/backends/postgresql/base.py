@@ -0,0 +1,46 @@
+from django.conf import settings as djset
+from django.db.backends.postgresql import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL с ленивой проверкой постоянных соединений.
+
+    Соединение проверяется не в начале каждого запроса, а при первом
+    курсоре в запросе или после ошибки базы, поэтому запросы, которые
+    не обращаются к базе (или к реплике), не платят за SELECT 1.
+    """
+
+    health_check_done = False
+
+    def connect(self):
+        super().connect()
+        # Только что открытое соединение проверять не нужно.
+        self.health_check_done = True
+
+    def close_if_health_check_failed(self):
+        if (self.connection is None
+                or not djset.DB_CONN_HEALTH_CHECKS
+                or (self.health_check_done and not self.errors_occurred)
+                or self.in_atomic_block
+                or not self.get_autocommit()):
+            return
+        if self.is_usable():
+            self.errors_occurred = False
+            self.health_check_done = True
+        else:
+            self.close()
+
+    def close_if_unusable_or_obsolete(self):
+        # Проверку после ошибки откладываем до следующего использования
+        # соединения, остальные правила закрытия остаются прежними.
+        errors_occurred = self.errors_occurred
+        self.errors_occurred = False
+        super().close_if_unusable_or_obsolete()
+        if self.connection is not None:
+            self.errors_occurred = errors_occurred
+            self.health_check_done = False
+
+    def _cursor(self, name=None):
+        self.close_if_health_check_failed()
+        return super()._cursor(name)
@@ -0,0 +1,99 @@
+import time
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, urlencode
+from rest_framework import status
+from rest_framework.response import Response
+
+from .replicas import current_replica
+
+CACHE_VERSION_KEY = 'api:version'
+
+
+def get_cache_version(key=CACHE_VERSION_KEY):
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time())
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def get_cache_versions(keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = get_cache_version(key)
+    return versions
+
+
+def bump_cache_version(key=CACHE_VERSION_KEY):
+    # incr атомарен, поэтому параллельные сбросы получают разные версии.
+    # Шаг догоняет текущее время: версия служит и отметкой Last-Modified.
+    now = int(time.time())
+    cache.add(key, now, None)
+    try:
+        return cache.incr(key, max(1, now - cache.get(key, now)))
+    except ValueError:
+        # Ключ вытеснили из кэша между add и incr.
+        cache.add(key, now, None)
+        return cache.incr(key)
+
+
+def can_cache(version):
+    # Реплика могла ещё не получить изменения, сделанные до смены версии:
+    # такие данные не кэшируются, чтобы не закрепить их на новой версии.
+    return (current_replica() is None
+            or time.time() - version > settings.DB_REPLICA_PIN_SECONDS)
+
+
+class CachedResponseMixin:
+    cached_actions = ('list', 'retrieve')
+    cache_authenticated = True
+
+    def get_cache_key(self, request, version):
+        partition = 'auth' if request.user.is_authenticated else 'anon'
+        query = urlencode(sorted(request.query_params.lists()), doseq=True)
+        key = f'{request.get_host()}{request.path}?{query}:{partition}'
+        return f'api:response:{version}:{md5(key.encode()).hexdigest()}'
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if (request.user.is_authenticated
+                and not self.cache_authenticated):
+            return handler(request, *args, **kwargs)
+        version = get_cache_version()
+        key = self.get_cache_key(request, version)
+        headers = {
+            'ETag': f'"{key.rsplit(":", 1)[-1]}-{version}"',
+            'Last-Modified': http_date(version),
+        }
+        not_modified = get_conditional_response(
+            request,
+            etag=headers['ETag'],
+            last_modified=version
+        )
+        if not_modified is not None:
+            return Response(status=not_modified.status_code, headers=headers)
+        data = cache.get(key)
+        if data is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            if can_cache(version):
+                cache.set(key, response.data, settings.API_CACHE_TIMEOUT)
+        else:
+            response = Response(data)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
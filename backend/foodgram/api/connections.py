@@ -0,0 +1,55 @@
+from django.conf import settings as djset
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def get_statement_timeout(method):
+    if method in SAFE_METHODS:
+        return djset.DB_READ_STATEMENT_TIMEOUT_MS
+    return djset.DB_WRITE_STATEMENT_TIMEOUT_MS
+
+
+def supports_statement_timeout(connection):
+    # При пулинге транзакций PgBouncer отдаёт соединение другим клиентам
+    # после каждой транзакции, и SET на уровне сессии утёк бы к ним.
+    return (connection.vendor == 'postgresql'
+            and djset.DB_POOLER != 'transaction')
+
+
+def apply_statement_timeout(connection):
+    timeout = getattr(connection, 'statement_timeout', None)
+    if timeout == getattr(connection, 'applied_statement_timeout', None):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SET statement_timeout = %s', [timeout or 0])
+    connection.applied_statement_timeout = timeout
+
+
+@receiver(connection_created)
+def init_connection(sender, connection, **kwargs):
+    connection.applied_statement_timeout = None
+    if supports_statement_timeout(connection):
+        apply_statement_timeout(connection)
+
+
+@receiver(request_started)
+def prepare_connections(sender, environ=None, **kwargs):
+    """
+    Выставляет statement_timeout по классу запроса.
+
+    Соединения старше CONN_MAX_AGE к этому моменту уже закрыты
+    обработчиком close_old_connections из django.db, а живые соединения
+    проверяет при первом использовании бэкенд api.backends.postgresql.
+    """
+    method = (environ or {}).get('REQUEST_METHOD', 'GET')
+    for connection in connections.all():
+        # Новое соединение получит таймаут в init_connection.
+        connection.statement_timeout = get_statement_timeout(method)
+        if connection.connection is None:
+            continue
+        if supports_statement_timeout(connection):
+            apply_statement_timeout(connection)
@@ -0,0 +1,109 @@
+import binascii
+import uuid
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from PIL import Image
+from rest_framework import serializers
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+    (b'GIF87a', 'gif', 'image/gif'),
+    (b'GIF89a', 'gif', 'image/gif'),
+)
+BASE64_CHUNK_SIZE = 4 * 2 ** 14
+
+
+def detect_image_format(header):
+    for signature, extension, content_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extension, content_type
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp', 'image/webp'
+    return None
+
+
+class Base64ImageField(serializers.ImageField):
+    """
+    Картинка в base64, которая декодируется по частям во временный файл.
+
+    Размер и формат проверяются до декодирования всей строки,
+    число пикселей - по заголовку картинки до её распаковки.
+    """
+
+    default_error_messages = {
+        'invalid_base64': 'Картинка должна быть строкой в base64',
+        'too_large': 'Размер картинки не должен превышать {max_bytes} байт',
+        'invalid_format': 'Поддерживаются картинки png, jpeg, gif и webp',
+        'too_many_pixels': 'Картинка не должна быть больше {max_pixels} '
+                           'пикселей',
+        'invalid_image': 'Файл повреждён или не является картинкой',
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str):
+            self.fail('invalid_base64')
+        start = data.find(';base64,')
+        start = 0 if start == -1 else start + len(';base64,')
+        max_bytes = settings.IMAGE_UPLOAD_MAX_BYTES
+        if (len(data) - start) // 4 * 3 > max_bytes + 3:
+            self.fail('too_large', max_bytes=max_bytes)
+        file = SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+        )
+        try:
+            extension, content_type = self.decode(data, start, file)
+            size = file.tell()
+            self.check_image(file)
+        except Exception:
+            file.close()
+            raise
+        file.seek(0)
+        return UploadedFile(
+            file=file,
+            name=f'{uuid.uuid4()}.{extension}',
+            content_type=content_type,
+            size=size
+        )
+
+    def decode(self, data, start, file):
+        image_format = None
+        pending = ''
+        for position in range(start, len(data), BASE64_CHUNK_SIZE):
+            pending += ''.join(
+                data[position:position + BASE64_CHUNK_SIZE].split()
+            )
+            cut = len(pending) - len(pending) % 4
+            try:
+                chunk = binascii.a2b_base64(pending[:cut])
+            except (binascii.Error, ValueError):
+                self.fail('invalid_base64')
+            pending = pending[cut:]
+            if image_format is None:
+                image_format = detect_image_format(chunk)
+                if image_format is None:
+                    self.fail('invalid_format')
+            file.write(chunk)
+        if pending or image_format is None:
+            self.fail('invalid_base64')
+        if file.tell() > settings.IMAGE_UPLOAD_MAX_BYTES:
+            self.fail('too_large', max_bytes=settings.IMAGE_UPLOAD_MAX_BYTES)
+        return image_format
+
+    def check_image(self, file):
+        max_pixels = settings.IMAGE_UPLOAD_MAX_PIXELS
+        file.seek(0)
+        try:
+            # Image.open читает только заголовок, сама картинка
+            # не распаковывается.
+            with Image.open(file) as image:
+                width, height = image.size
+                if width * height > max_pixels:
+                    self.fail('too_many_pixels', max_pixels=max_pixels)
+                image.verify()
+        except Image.DecompressionBombError:
+            self.fail('too_many_pixels', max_pixels=max_pixels)
+        except (OSError, SyntaxError, ValueError):
+            self.fail('invalid_image')
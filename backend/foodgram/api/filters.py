@@ -1,6 +1,8 @@
-from django_filters.filters import CharFilter, ModelMultipleChoiceFilter
+from django_filters.filters import (CharFilter, ChoiceFilter,
+                                    ModelMultipleChoiceFilter, NumberFilter)
 from django_filters.rest_framework import FilterSet
-from recipes.models import Ingredient, Recipe, Tag
+from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
+from recipes.search import search_recipes
 
 
 class RecipeFilter(FilterSet):
@@ -10,10 +12,40 @@ class RecipeFilter(FilterSet):
         conjoined=False,
         queryset=Tag.objects.all()
     )
+    is_favorited = NumberFilter(method='filter_is_favorited')
+    is_in_shopping_cart = NumberFilter(method='filter_is_in_shopping_cart')
+    search = CharFilter(method='filter_search')
+    ordering = ChoiceFilter(
+        choices=(('popular', 'Популярные'), ('trending', 'В трендах')),
+        method='filter_ordering'
+    )
 
     class Meta:
         model = Recipe
-        fields = ['author', 'tags']
+        fields = ['author', 'tags', 'is_favorited', 'is_in_shopping_cart',
+                  'search', 'ordering']
+
+    def filter_by_user_recipes(self, queryset, model, value):
+        if not value:
+            return queryset
+        user = self.request.user
+        if user.is_anonymous:
+            return queryset.none()
+        return queryset.filter(
+            id__in=model.objects.filter(user=user).values('recipe_id')
+        )
+
+    def filter_is_favorited(self, queryset, name, value):
+        return self.filter_by_user_recipes(queryset, Favorite, value)
+
+    def filter_is_in_shopping_cart(self, queryset, name, value):
+        return self.filter_by_user_recipes(queryset, ShoppingCart, value)
+
+    def filter_search(self, queryset, name, value):
+        return search_recipes(queryset, value)
+
+    def filter_ordering(self, queryset, name, value):
+        return queryset.order_by(f'-{value}_score', '-id')
 
 
 class IngredientFilter(FilterSet):
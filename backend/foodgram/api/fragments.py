@@ -0,0 +1,154 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import prefetch_related_objects
+from rest_framework import serializers
+
+from .cache import bump_cache_version, can_cache, get_cache_versions
+from .metrics import SerializerTimingMixin
+
+FRAGMENTS_VERSION_KEY = 'api:recipe_fragments:version'
+RECIPE_VERSION_KEY = 'api:recipe_fragments:recipe:{}'
+AUTHOR_VERSION_KEY = 'api:recipe_fragments:author:{}'
+
+
+class RecipeFragments:
+    """
+    Не зависящие от пользователя части ответа по рецептам.
+
+    Ключ фрагмента складывается из версий рецепта, его автора
+    и общей версии тегов и ингредиентов, поэтому любое изменение
+    делает старый фрагмент недоступным.
+    """
+
+    def __init__(self, recipes, host):
+        versions = get_cache_versions(
+            [FRAGMENTS_VERSION_KEY]
+            + [RECIPE_VERSION_KEY.format(recipe.id) for recipe in recipes]
+            + [AUTHOR_VERSION_KEY.format(recipe.author_id)
+               for recipe in recipes]
+        )
+        self.keys = {}
+        self.versions = {}
+        for recipe in recipes:
+            recipe_versions = (
+                versions[FRAGMENTS_VERSION_KEY],
+                versions[AUTHOR_VERSION_KEY.format(recipe.author_id)],
+                versions[RECIPE_VERSION_KEY.format(recipe.id)],
+            )
+            self.keys[recipe.id] = 'api:recipe_fragment:{}:{}:{}'.format(
+                recipe.id, '.'.join(map(str, recipe_versions)), host
+            )
+            self.versions[recipe.id] = max(recipe_versions)
+        cached = cache.get_many(list(self.keys.values()))
+        self.fragments = {
+            recipe_id: cached[key]
+            for recipe_id, key in self.keys.items() if key in cached
+        }
+        self.new_fragments = {}
+
+    def get(self, recipe_id):
+        return self.fragments.get(recipe_id)
+
+    def add(self, recipe_id, fragment):
+        self.fragments[recipe_id] = fragment
+        if recipe_id in self.keys and can_cache(self.versions[recipe_id]):
+            self.new_fragments[self.keys[recipe_id]] = fragment
+
+    def save(self):
+        if self.new_fragments:
+            cache.set_many(
+                self.new_fragments, settings.RECIPE_FRAGMENT_TIMEOUT
+            )
+            self.new_fragments = {}
+
+
+class RecipeFragmentListSerializer(SerializerTimingMixin,
+                                   serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        instances = list(iterable)
+        self.child.load_fragments(instances)
+        try:
+            return [self.child.to_representation(item) for item in instances]
+        finally:
+            self.child.save_fragments()
+
+
+class RecipeFragmentMixin:
+    """
+    Берёт поля fragment_fields из кэша фрагментов, остальные поля
+    (флаги текущего пользователя) вычисляет при каждом запросе.
+
+    Связи из get_fragment_prefetch загружаются только для объектов,
+    которых нет в кэше.
+    """
+
+    fragment_fields = ()
+    fragments = None
+
+    def get_fragment_prefetch(self):
+        return ()
+
+    def load_fragments(self, instances):
+        request = self.context.get('request')
+        self.fragments = RecipeFragments(
+            instances, request.get_host() if request is not None else ''
+        )
+        missing = [
+            instance for instance in instances
+            if self.fragments.get(instance.id) is None
+        ]
+        prefetch = self.get_fragment_prefetch()
+        if missing and prefetch:
+            prefetch_related_objects(missing, *prefetch)
+
+    def save_fragments(self):
+        self.fragments.save()
+        self.fragments = None
+
+    def split_fragment(self, data):
+        return {field: data[field] for field in self.fragment_fields}
+
+    def merge_fragment(self, fragment, instance):
+        data = OrderedDict()
+        for field in self._readable_fields:
+            if field.field_name in fragment:
+                data[field.field_name] = fragment[field.field_name]
+                continue
+            attribute = field.get_attribute(instance)
+            data[field.field_name] = (
+                None if attribute is None
+                else field.to_representation(attribute)
+            )
+        return data
+
+    def to_representation(self, instance):
+        single = self.fragments is None
+        if single:
+            self.load_fragments([instance])
+        try:
+            fragment = self.fragments.get(instance.id)
+            if fragment is not None:
+                return self.merge_fragment(fragment, instance)
+            data = super().to_representation(instance)
+            self.fragments.add(instance.id, self.split_fragment(data))
+            return data
+        finally:
+            if single:
+                self.save_fragments()
+
+
+def invalidate_recipe_fragments(recipe_ids):
+    for recipe_id in recipe_ids:
+        bump_cache_version(RECIPE_VERSION_KEY.format(recipe_id))
+
+
+def invalidate_author_fragments(author_id):
+    bump_cache_version(AUTHOR_VERSION_KEY.format(author_id))
+
+
+def invalidate_all_fragments():
+    bump_cache_version(FRAGMENTS_VERSION_KEY)
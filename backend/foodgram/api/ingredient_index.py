@@ -0,0 +1,52 @@
+from bisect import bisect_left
+
+from recipes.models import Ingredient
+
+from .cache import get_cache_version
+
+INGREDIENTS_VERSION_KEY = 'api:ingredients:version'
+
+
+def normalize(name):
+    return (name or '').casefold().replace('ё', 'е')
+
+
+class IngredientIndex:
+    def __init__(self, ingredients, version=None):
+        entries = sorted(
+            (normalize(ingredient['name']), ingredient['id'], ingredient)
+            for ingredient in ingredients
+        )
+        self.names = tuple(entry[0] for entry in entries)
+        self.ingredients = tuple(entry[2] for entry in entries)
+        self.version = version
+
+    def search(self, query):
+        query = normalize(query)
+        start = bisect_left(self.names, query)
+        end = start
+        while end < len(self.names) and self.names[end].startswith(query):
+            end += 1
+        substring_matches = [
+            ingredient
+            for position, (name, ingredient)
+            in enumerate(zip(self.names, self.ingredients))
+            if query in name and not start <= position < end
+        ]
+        return list(self.ingredients[start:end]) + substring_matches
+
+
+_index = None
+
+
+def get_ingredient_index():
+    global _index
+    version = get_cache_version(INGREDIENTS_VERSION_KEY)
+    index = _index
+    if index is None or index.version != version:
+        index = IngredientIndex(
+            Ingredient.objects.values('id', 'name', 'measurement_unit'),
+            version
+        )
+        _index = index
+    return index
@@ -0,0 +1,536 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import time
+import tracemalloc
+from base64 import b64encode
+from contextlib import ExitStack
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from urllib.parse import parse_qsl, urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import connection, connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext, override_settings
+from foodgram.asgi import application as asgi_application
+from PIL import Image
+from recipes.images import get_executor
+from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
+                            ShoppingCart, Tag)
+from rest_framework.test import APIClient
+from users.models import Follow, User
+
+LOCAL_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+SERIALIZER_TIMING = re.compile(r'serializer;dur=([\d.]+)')
+LARGE_IMAGE_SIZE = (1600, 1200)
+SLOW_CLIENTS = 50
+SLOW_CLIENT_CHUNKS = 20
+SLOW_CLIENT_DELAY = 0.05
+TAGS = (
+    ('Завтрак', '#E26C2D', 'breakfast'),
+    ('Обед', '#49B64E', 'lunch'),
+    ('Ужин', '#8775D2', 'dinner'),
+    ('Десерт', '#F9A62B', 'dessert'),
+    ('Выпечка', '#B65C49', 'bakery'),
+)
+
+
+def zipf_weights(size, exponent=1.1):
+    return [1 / (rank ** exponent) for rank in range(1, size + 1)]
+
+
+def power_law_count(rng, mean, limit):
+    # Парето с хвостом: большинству пользователей - немного связей,
+    # единицам - очень много.
+    return min(limit, int(rng.paretovariate(1.5) * mean / 3))
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+
+def image_data(rng):
+    output = BytesIO()
+    color = tuple(rng.randrange(256) for _ in range(3))
+    Image.new('RGB', (64, 48), color).save(output, 'PNG')
+    return 'data:image/png;base64,' + b64encode(output.getvalue()).decode()
+
+
+def large_image_data(size=LARGE_IMAGE_SIZE):
+    # Шум почти не сжимается: PNG получается в несколько мегабайт,
+    # как фотография с телефона.
+    output = BytesIO()
+    Image.merge('RGB', [Image.effect_noise(size, 64) for _ in range(3)]).save(
+        output, 'PNG'
+    )
+    return 'data:image/png;base64,' + b64encode(output.getvalue()).decode()
+
+
+class AsgiResponse:
+    """Ответ приложения ASGI с тем же интерфейсом, что у тестового клиента."""
+
+    def __init__(self, messages):
+        self.status_code = messages[0]['status']
+        self.headers = {
+            name.decode().lower(): value.decode()
+            for name, value in messages[0].get('headers', [])
+        }
+        self.data = b''.join(
+            message.get('body', b'') for message in messages[1:]
+        )
+
+    def get(self, header, default=None):
+        return self.headers.get(header.lower(), default)
+
+
+async def asgi_request(method, path, chunks=(), delay=0):
+    """Запрос к foodgram.asgi, тело приходит частями с паузой delay."""
+    chunks = list(chunks)
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'host', b'testserver'),
+                    (b'content-type', b'application/json')],
+        'client': ('127.0.0.1', 0),
+        'server': ('testserver', 80),
+    }
+    messages = []
+
+    async def receive():
+        await asyncio.sleep(delay)
+        body = chunks.pop(0) if chunks else b''
+        return {'type': 'http.request', 'body': body,
+                'more_body': bool(chunks)}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_application(scope, receive, send)
+    return AsgiResponse(messages)
+
+
+class Command(BaseCommand):
+    help = 'Run API benchmarks on a generated database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument(
+            '--power-user-recipes',
+            type=int,
+            default=10000,
+            help='Favorites and cart size of the power user '
+                 '(at most --recipes)'
+        )
+        parser.add_argument(
+            '--memory-iterations',
+            type=int,
+            default=10,
+            help='Requests per scenario in the memory measurement pass'
+        )
+        parser.add_argument(
+            '--ingredients',
+            type=str,
+            default=os.path.join('data', 'ingredients.csv'),
+            help='Ingredient fixture loaded with import_i'
+        )
+        parser.add_argument(
+            '--scenario',
+            action='append',
+            help='Run only the given scenarios'
+        )
+        parser.add_argument('--baseline', type=str,
+                            help='Compare results with this JSON file')
+        parser.add_argument('--save', type=str,
+                            help='Write results to this JSON file')
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help='Allowed relative p95 slowdown against the baseline'
+        )
+
+    def generate(self, rng, users_count, recipes_count, power_user_recipes):
+        ingredients = list(Ingredient.objects.values_list('id', flat=True))
+        if not ingredients:
+            raise CommandError('Не загружены ингредиенты')
+        ingredient_weights = zipf_weights(len(ingredients))
+        tags = [
+            Tag.objects.create(name=name, color=color, slug=slug)
+            for name, color, slug in TAGS
+        ]
+        User.objects.bulk_create(
+            User(username=f'user{number}', email=f'user{number}@example.com',
+                 first_name='Имя', last_name='Фамилия')
+            for number in range(users_count)
+        )
+        users = list(User.objects.values_list('id', flat=True))
+        user_weights = zipf_weights(len(users))
+        Recipe.objects.bulk_create((
+            Recipe(
+                author_id=rng.choices(users, user_weights)[0],
+                name=f'Рецепт {number}',
+                text='Описание рецепта',
+                cooking_time=rng.randint(5, 120),
+                image='recipe.png'
+            )
+            for number in range(recipes_count)
+        ), batch_size=400)
+        recipes = list(Recipe.objects.values_list('id', flat=True))
+        recipe_weights = zipf_weights(len(recipes))
+        amounts = []
+        recipe_tags = []
+        for recipe_id in recipes:
+            for ingredient_id in set(rng.choices(
+                ingredients, ingredient_weights, k=rng.randint(3, 15)
+            )):
+                amounts.append(IngredientAmount(
+                    recipe_id=recipe_id, ingredient_id=ingredient_id,
+                    amount=rng.randint(1, 500)
+                ))
+            for tag in rng.sample(tags, rng.randint(1, 3)):
+                recipe_tags.append(Recipe.tags.through(
+                    recipe_id=recipe_id, tag_id=tag.id
+                ))
+        IngredientAmount.objects.bulk_create(amounts, batch_size=400)
+        Recipe.tags.through.objects.bulk_create(recipe_tags, batch_size=400)
+        favorites, carts, follows = [], [], []
+        for user_id in users:
+            for recipe_id in set(rng.choices(
+                recipes, recipe_weights,
+                k=power_law_count(rng, 20, len(recipes))
+            )):
+                favorites.append(Favorite(user_id=user_id,
+                                          recipe_id=recipe_id))
+            for recipe_id in set(rng.choices(
+                recipes, recipe_weights,
+                k=power_law_count(rng, 5, len(recipes))
+            )):
+                carts.append(ShoppingCart(user_id=user_id,
+                                          recipe_id=recipe_id))
+            for author_id in set(rng.choices(
+                users, user_weights, k=power_law_count(rng, 10, len(users))
+            )) - {user_id}:
+                follows.append(Follow(user_id=user_id, author_id=author_id))
+        Favorite.objects.bulk_create(favorites, batch_size=400)
+        ShoppingCart.objects.bulk_create(carts, batch_size=400)
+        Follow.objects.bulk_create(follows, batch_size=400)
+        # Пользователь с тысячами рецептов в избранном и корзине: на нём видно,
+        # растут ли память и число запросов вместе с объёмом данных.
+        power_user = User.objects.create(
+            username='power', email='power@example.com',
+            first_name='Имя', last_name='Фамилия'
+        )
+        for model in (Favorite, ShoppingCart):
+            model.objects.bulk_create((
+                model(user=power_user, recipe_id=recipe_id)
+                for recipe_id in recipes[:power_user_recipes]
+            ), batch_size=400)
+        # Денормализованные данные заполняются так же, как после миграций.
+        call_command('reconcile_counters',
+                     stdout=StringIO(), stderr=StringIO())
+        call_command('rebuild_shopping_list',
+                     stdout=StringIO(), stderr=StringIO())
+        return users, tags, power_user.id
+
+    def get_scenarios(self, rng, users, tags, power_user):
+        ingredients = list(Ingredient.objects.values_list('id', 'name'))
+        prefixes = [name[:3] for _, name in rng.sample(ingredients, 20)]
+        clients = {}
+
+        def client(user_id):
+            if user_id not in clients:
+                clients[user_id] = APIClient()
+                clients[user_id].force_authenticate(
+                    User.objects.get(pk=user_id)
+                )
+            return clients[user_id]
+
+        def get(path, params=None):
+            return lambda user_id: client(user_id).get(path, params)
+
+        def download_shopping_cart(user_id):
+            response = client(user_id).get(
+                '/api/recipes/download_shopping_cart/'
+            )
+            # Ответ читается по частям, как его получает клиент.
+            for _ in response.streaming_content:
+                pass
+            return response
+
+        def create_recipe(user_id, image=None):
+            return client(user_id).post('/api/recipes/', {
+                'name': 'Новый рецепт',
+                'text': 'Описание',
+                'cooking_time': 10,
+                'tags': [rng.choice(tags).id],
+                'image': image or image_data(rng),
+                'ingredients': [
+                    {'id': ingredient_id, 'amount': 100}
+                    for ingredient_id, _ in rng.sample(ingredients, 5)
+                ],
+            }, format='json')
+
+        def with_settings(scenario, **options):
+            def request(user_id):
+                with override_settings(**options):
+                    return scenario(user_id)
+            return request
+
+        def autocomplete(user_id):
+            return client(user_id).get(
+                '/api/ingredients/', {'name': rng.choice(prefixes)}
+            )
+
+        # Метрики отдаются только администратору.
+        admin = User.objects.create(
+            username='admin', email='admin@example.com',
+            first_name='Имя', last_name='Фамилия', is_superuser=True
+        )
+
+        def walk_cursor(pages, limit):
+            # Курсор после pages * limit рецептов: проход по ссылкам next,
+            # как при бесконечной прокрутке.
+            params = {'cursor': '', 'limit': limit}
+            for _ in range(pages):
+                response = client(users[0]).get('/api/recipes/', params)
+                params = dict(parse_qsl(urlsplit(response.data['next']).query))
+            return params['cursor']
+
+        # Глубокая страница - на 90% ленты, одинаковая для обоих способов.
+        walk_limit = settings.PAGE_LIMIT * 10
+        walk_pages = Recipe.objects.count() * 9 // 10 // walk_limit
+        deep_cursor = walk_cursor(walk_pages, walk_limit)
+        deep_page = walk_pages * walk_limit // settings.PAGE_LIMIT + 1
+
+        def asgi_slow_clients(user_id):
+            # Пока медленные клиенты по частям отправляют тела запросов,
+            # обычный запрос не должен ждать свободного потока.
+            async def run():
+                slow = [
+                    asyncio.ensure_future(asgi_request(
+                        'POST', '/api/auth/token/login/',
+                        [b' ' * 64] * SLOW_CLIENT_CHUNKS, SLOW_CLIENT_DELAY
+                    ))
+                    for _ in range(SLOW_CLIENTS)
+                ]
+                await asyncio.sleep(0)
+                try:
+                    return await asgi_request('GET', '/api/recipes/')
+                finally:
+                    for task in slow:
+                        task.cancel()
+                    await asyncio.gather(*slow, return_exceptions=True)
+            return self.loop.run_until_complete(run())
+
+        # Картинка готовится один раз, чтобы её кодирование не попадало
+        # в замер времени и памяти.
+        large_image = large_image_data()
+
+        return {
+            'recipes_list': get('/api/recipes/'),
+            # Разница с recipes_list - цена MetricsMiddleware.
+            'recipes_list_no_metrics': with_settings(
+                get('/api/recipes/'), METRICS_ENABLED=False
+            ),
+            'metrics': lambda user_id: client(admin.id).get('/api/metrics/'),
+            'recipes_filtered': lambda user_id: client(user_id).get(
+                '/api/recipes/',
+                {'tags': rng.choice(tags).slug, 'is_favorited': 1}
+            ),
+            'recipes_favorited_large': lambda user_id: client(
+                power_user
+            ).get(
+                '/api/recipes/',
+                {'tags': rng.choice(tags).slug, 'is_favorited': 1}
+            ),
+            'recipes_cursor': get('/api/recipes/', {'cursor': ''}),
+            'recipes_deep_cursor': get('/api/recipes/',
+                                       {'cursor': deep_cursor}),
+            'recipes_deep_page': get('/api/recipes/', {'page': deep_page}),
+            'users_list': get('/api/users/'),
+            'users_me': get('/api/users/me/'),
+            'subscriptions': get('/api/users/subscriptions/'),
+            'download_shopping_cart': download_shopping_cart,
+            'download_shopping_cart_large': lambda user_id: (
+                download_shopping_cart(power_user)
+            ),
+            'ingredient_autocomplete': autocomplete,
+            # Кэш ответов отключён, чтобы сравнивать сам поиск:
+            # индекс в памяти или istartswith в базе.
+            'ingredient_autocomplete_index': with_settings(
+                autocomplete, INGREDIENT_INDEX=True, API_CACHE_TIMEOUT=0
+            ),
+            'ingredient_autocomplete_db': with_settings(
+                autocomplete, INGREDIENT_INDEX=False, API_CACHE_TIMEOUT=0
+            ),
+            'asgi_slow_clients': asgi_slow_clients,
+            'recipe_create': create_recipe,
+            'recipe_create_large_image': lambda user_id: create_recipe(
+                user_id, large_image
+            ),
+        }
+
+    def run_scenario(self, rng, scenario, users, iterations):
+        cache.clear()
+        latencies, queries, serializer_times = [], [], []
+        for iteration in range(iterations + 1):
+            user_id = rng.choice(users)
+            with ExitStack() as stack:
+                # Чтение может идти на реплики, поэтому запросы
+                # считаются по всем соединениям.
+                contexts = [
+                    stack.enter_context(CaptureQueriesContext(db))
+                    for db in connections.all()
+                ]
+                start = time.perf_counter()
+                response = scenario(user_id)
+                elapsed = time.perf_counter() - start
+            if response.status_code >= 400:
+                raise CommandError(
+                    f'Ответ {response.status_code}: {response.data}'
+                )
+            # Первый запрос прогревает кэши и не учитывается.
+            if iteration:
+                latencies.append(elapsed * 1000)
+                queries.append(sum(map(len, contexts)))
+                # Время сериализации отдаёт MetricsMiddleware.
+                timing = SERIALIZER_TIMING.search(
+                    response.get('Server-Timing', '')
+                )
+                serializer_times.append(float(timing[1]) if timing else 0.0)
+        return {
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'serializer_p50_ms': round(percentile(serializer_times, 0.5), 2),
+            'queries': round(sum(queries) / len(queries), 1),
+        }
+
+    def measure_memory(self, rng, scenario, users, iterations):
+        # Пик памяти, выделенной за сценарий, без учёта предыдущих.
+        # Трассировка замедляет запросы, поэтому идёт отдельным прогоном
+        # после замера времени.
+        tracemalloc.start()
+        try:
+            for _ in range(iterations):
+                scenario(rng.choice(users))
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def compare(self, results, baseline, tolerance):
+        regressions = []
+        for name, result in results.items():
+            expected = baseline.get(name)
+            if expected is None:
+                continue
+            if result['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+                regressions.append(
+                    f'{name}: p95 {result["p95_ms"]} мс, '
+                    f'было {expected["p95_ms"]} мс'
+                )
+            if result['queries'] > expected['queries']:
+                regressions.append(
+                    f'{name}: запросов {result["queries"]}, '
+                    f'было {expected["queries"]}'
+                )
+        return regressions
+
+    def handle(self, *args, **kwargs):
+        if not os.path.isfile(kwargs['ingredients']):
+            raise CommandError(f'Файл {kwargs["ingredients"]} не найден')
+        rng = random.Random(kwargs['seed'])
+        # Замеры идут на отдельной тестовой базе, рабочие данные
+        # не затрагиваются. SQLite-база создаётся во временном файле:
+        # общая база в памяти блокирует таблицы для фоновых потоков.
+        media = TemporaryDirectory()
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                media.name, 'benchmark.sqlite3'
+            )
+        self.loop = asyncio.new_event_loop()
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        # Кэш тоже отдельный: cache.clear() между сценариями
+        # не должен очищать общий Redis.
+        benchmark_settings = override_settings(
+            MEDIA_ROOT=media.name, CACHES=LOCAL_CACHES
+        )
+        benchmark_settings.enable()
+        try:
+            call_command('import_i', path=kwargs['ingredients'],
+                         stdout=StringIO())
+            users, tags, power_user = self.generate(
+                rng, kwargs['users'], kwargs['recipes'],
+                kwargs['power_user_recipes']
+            )
+            scenarios = self.get_scenarios(rng, users, tags, power_user)
+            names = kwargs['scenario'] or list(scenarios)
+            unknown = set(names) - set(scenarios)
+            if unknown:
+                raise CommandError(
+                    'Неизвестные сценарии: ' + ', '.join(sorted(unknown))
+                )
+            results = {}
+            self.stdout.write(
+                f'{"scenario":<32}{"p50":>9}{"p95":>9}{"p99":>9}'
+                f'{"serializer":>12}{"queries":>9}{"peak MB":>9}'
+            )
+            for name in names:
+                result = self.run_scenario(
+                    rng, scenarios[name], users, kwargs['iterations']
+                )
+                result['peak_memory_mb'] = round(self.measure_memory(
+                    rng, scenarios[name], users, kwargs['memory_iterations']
+                ) / 2 ** 20, 1)
+                results[name] = result
+                self.stdout.write(
+                    f'{name:<32}{result["p50_ms"]:>9}{result["p95_ms"]:>9}'
+                    f'{result["p99_ms"]:>9}{result["serializer_p50_ms"]:>12}'
+                    f'{result["queries"]:>9}'
+                    f'{result["peak_memory_mb"]:>9}'
+                )
+        finally:
+            # Дожидаемся фоновой нарезки картинок созданных рецептов.
+            # Без фоновых потоков копии уже готовы, а пул с нулём потоков
+            # создать нельзя.
+            if settings.IMAGE_RENDITION_WORKERS:
+                get_executor().shutdown(wait=True)
+            # Потоки ASGI держат свои соединения с тестовой базой.
+            self.loop.close()
+            asgi_application.executor.shutdown(wait=True)
+            benchmark_settings.disable()
+            runner.teardown_databases(old_config)
+            media.cleanup()
+        if kwargs['save']:
+            with open(kwargs['save'], mode='w') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        if kwargs['baseline']:
+            with open(kwargs['baseline']) as f:
+                baseline = json.load(f)
+            regressions = self.compare(results, baseline, kwargs['tolerance'])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f'Регрессий: {len(regressions)}')
+            self.stdout.write(self.style.SUCCESS('Регрессий нет'))
@@ -0,0 +1,130 @@
+import math
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from recipes.models import Favorite, Recipe, ShoppingCart
+
+from api.cache import bump_cache_version
+
+FAVORITE_WEIGHT = 2
+SHOPPING_CART_WEIGHT = 1
+EVENT_MODELS = (
+    (Favorite, FAVORITE_WEIGHT),
+    (ShoppingCart, SHOPPING_CART_WEIGHT),
+)
+POPULAR_SCORE = (F('favorites_count') * FAVORITE_WEIGHT
+                 + F('in_carts_count') * SHOPPING_CART_WEIGHT)
+TRENDING_EPOCH = datetime(2021, 1, 1, tzinfo=timezone.utc)
+SCORES_UPDATED_KEY = 'api:scores:updated'
+BATCH_SIZE = 500
+
+
+def trending_exponent(created):
+    half_life = settings.TRENDING_HALF_LIFE_HOURS * 3600
+    return (created - TRENDING_EPOCH).total_seconds() / half_life
+
+
+def trending_score(events):
+    """
+    log2 суммы weight * 2 ** ((created - epoch) / half_life).
+
+    Сумма отсчитывается от постоянной эпохи, поэтому старые рейтинги
+    не нужно уменьшать при каждом пересчёте: порядок рецептов тот же,
+    что и у рейтингов, затухающих от текущего момента. Логарифм не даёт
+    сумме переполниться с ростом времени.
+    """
+    if not events:
+        return 0
+    peak = max(exponent for _, exponent in events)
+    return peak + math.log2(sum(
+        weight * 2 ** (exponent - peak) for weight, exponent in events
+    ))
+
+
+class Command(BaseCommand):
+    help = 'Refresh popular and trending recipe scores'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Recompute scores of all recipes'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Repeat every N seconds instead of running once'
+        )
+
+    def get_changed(self, last_update):
+        # Удалённое событие меняет счётчики рецепта, поэтому такие рецепты
+        # находятся по расхождению popular_score со счётчиками.
+        changed = set(Recipe.objects.exclude(
+            popular_score=POPULAR_SCORE
+        ).values_list('id', flat=True))
+        for model, _ in EVENT_MODELS:
+            events = model.objects.all()
+            if last_update is not None:
+                events = events.filter(created__gt=last_update)
+            changed.update(
+                events.values_list('recipe_id', flat=True).distinct()
+            )
+        return changed
+
+    def get_events(self, recipe_ids):
+        events = defaultdict(list)
+        for model, weight in EVENT_MODELS:
+            for recipe_id, created in model.objects.filter(
+                recipe_id__in=recipe_ids
+            ).values_list('recipe_id', 'created').order_by():
+                events[recipe_id].append((weight, trending_exponent(created)))
+        return events
+
+    @transaction.atomic
+    def refresh(self, full):
+        now = time.time()
+        last_update = None if full else cache.get(SCORES_UPDATED_KEY)
+        if last_update is None:
+            # Без отметки о прошлом пересчёте считаем всё заново.
+            Recipe.objects.exclude(trending_score=0).update(trending_score=0)
+        else:
+            last_update = datetime.fromtimestamp(last_update, tz=timezone.utc)
+        recipe_ids = sorted(self.get_changed(last_update))
+        for start in range(0, len(recipe_ids), BATCH_SIZE):
+            batch = recipe_ids[start:start + BATCH_SIZE]
+            events = self.get_events(batch)
+            Recipe.objects.bulk_update(
+                [
+                    Recipe(id=recipe_id, popular_score=POPULAR_SCORE,
+                           trending_score=trending_score(events[recipe_id]))
+                    for recipe_id in batch
+                ],
+                ['popular_score', 'trending_score']
+            )
+        # События, появившиеся во время пересчёта, попадут в следующий.
+        transaction.on_commit(
+            lambda: cache.set(SCORES_UPDATED_KEY, now, None)
+        )
+        if recipe_ids:
+            transaction.on_commit(bump_cache_version)
+        return len(recipe_ids)
+
+    def handle(self, *args, **kwargs):
+        full = kwargs['full']
+        while True:
+            updated = self.refresh(full)
+            self.stdout.write(self.style.SUCCESS(
+                f'Рейтинги обновлены, изменённых рецептов: {updated}'
+            ))
+            if not kwargs['interval']:
+                break
+            full = False
+            time.sleep(kwargs['interval'])
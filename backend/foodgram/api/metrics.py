@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import defaultdict
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_state = threading.local()
+
+
+class RequestMetrics:
+    def __init__(self, collect_sql=False):
+        self.start = time.perf_counter()
+        self.view = None
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.sql = [] if collect_sql else None
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.queries += 1
+            if self.sql is not None:
+                self.sql.append(sql)
+
+
+def start_request(collect_sql=False):
+    _state.metrics = RequestMetrics(collect_sql)
+    return _state.metrics
+
+
+def finish_request():
+    return _state.__dict__.pop('metrics', None)
+
+
+def current_request():
+    return getattr(_state, 'metrics', None)
+
+
+class SerializerTimingMixin:
+    """Учитывает время сериализации верхнего уровня в метриках запроса."""
+
+    def to_representation(self, instance):
+        metrics = current_request()
+        if metrics is None:
+            return super().to_representation(instance)
+        metrics.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serializer_depth -= 1
+            if not metrics.serializer_depth:
+                metrics.serializer_time += time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(lambda: Histogram(DURATION_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.sql_time = defaultdict(float)
+        self.serializer_time = defaultdict(float)
+
+    def observe(self, view, total, metrics):
+        with self.lock:
+            self.durations[view].observe(total)
+            self.queries[view].observe(metrics.queries)
+            self.sql_time[view] += metrics.sql_time
+            self.serializer_time[view] += metrics.serializer_time
+
+    def render_histogram(self, name, help_text, histograms):
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for view, histogram in sorted(histograms.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(
+                    f'{name}_bucket{{view="{view}",le="{bound}"}} {count}'
+                )
+            lines.append(
+                f'{name}_bucket{{view="{view}",le="+Inf"}} {histogram.count}'
+            )
+            lines.append(f'{name}_sum{{view="{view}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{view="{view}"}} {histogram.count}')
+        return lines
+
+    def render_counter(self, name, help_text, values):
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for view, value in sorted(values.items()):
+            lines.append(f'{name}{{view="{view}"}} {value}')
+        return lines
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus."""
+        with self.lock:
+            lines = (
+                self.render_histogram(
+                    'foodgram_request_duration_seconds',
+                    'Request duration by view.',
+                    self.durations
+                )
+                + self.render_histogram(
+                    'foodgram_request_queries',
+                    'SQL queries per request by view.',
+                    self.queries
+                )
+                + self.render_counter(
+                    'foodgram_request_sql_seconds_total',
+                    'Time spent in SQL by view.',
+                    self.sql_time
+                )
+                + self.render_counter(
+                    'foodgram_request_serializer_seconds_total',
+                    'Time spent in serializers by view.',
+                    self.serializer_time
+                )
+            )
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,143 @@
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import ExitStack
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+from . import metrics as request_metrics
+from .replicas import set_replica
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'primary_pin'
+PIN_KEY = 'api:primary_pin:{}'
+
+
+def get_view_name(view_func, request):
+    actions = getattr(view_func, 'actions', None)
+    if actions:
+        action = actions.get(request.method.lower(), request.method.lower())
+        return f'{view_func.cls.__name__}.{action}'
+    return getattr(view_func, '__name__', view_func.__class__.__name__)
+
+
+class MetricsMiddleware:
+    """
+    Считает запросы к базе и время обработки по каждому представлению:
+    отдаёт их в заголовке Server-Timing и копит гистограммы для /api/metrics/.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+        budget = (settings.METRICS_QUERY_BUDGET is not None
+                  or settings.METRICS_TIME_BUDGET_MS is not None)
+        metrics = request_metrics.start_request(collect_sql=budget)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(metrics.execute_wrapper)
+                    )
+                response = self.get_response(request)
+        finally:
+            request_metrics.finish_request()
+        total = time.perf_counter() - metrics.start
+        view = metrics.view or 'unresolved'
+        request_metrics.registry.observe(view, total, metrics)
+        response['Server-Timing'] = self.server_timing(total, metrics)
+        if budget:
+            self.check_budget(request, view, total, metrics)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = request_metrics.current_request()
+        if metrics is not None:
+            metrics.view = get_view_name(view_func, request)
+
+    @staticmethod
+    def server_timing(total, metrics):
+        app_time = max(total - metrics.sql_time - metrics.serializer_time, 0)
+        return ', '.join((
+            f'db;dur={metrics.sql_time * 1000:.1f};'
+            f'desc="{metrics.queries} queries"',
+            f'serializer;dur={metrics.serializer_time * 1000:.1f}',
+            f'app;dur={app_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ))
+
+    @staticmethod
+    def check_budget(request, view, total, metrics):
+        query_budget = settings.METRICS_QUERY_BUDGET
+        time_budget = settings.METRICS_TIME_BUDGET_MS
+        if not ((query_budget is not None and metrics.queries > query_budget)
+                or (time_budget is not None
+                    and total * 1000 > time_budget)):
+            return
+        duplicates = [
+            f'{count} x {sql}'
+            for sql, count in Counter(metrics.sql).most_common()
+            if count > 1
+        ]
+        logger.warning(
+            '%s %s (%s): %s queries, %.1f ms. Duplicated SQL:\n%s',
+            request.method, request.get_full_path(), view, metrics.queries,
+            total * 1000, '\n'.join(duplicates) or '-'
+        )
+
+
+class ReplicaMiddleware:
+    """
+    Направляет чтение безопасных запросов на случайную реплику.
+
+    После записи клиент на DB_REPLICA_PIN_SECONDS закрепляется
+    за основной базой, чтобы видеть свои изменения: по cookie
+    и по заголовку Authorization для клиентов без cookie.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.DB_REPLICAS:
+            return self.get_response(request)
+        if request.method in SAFE_METHODS and not self.is_pinned(request):
+            set_replica(random.choice(settings.DB_REPLICAS))
+        try:
+            response = self.get_response(request)
+        finally:
+            set_replica(None)
+        if request.method not in SAFE_METHODS:
+            self.pin(request, response)
+        return response
+
+    @staticmethod
+    def get_pin_key(request):
+        authorization = request.META.get('HTTP_AUTHORIZATION')
+        if not authorization:
+            return None
+        return PIN_KEY.format(md5(authorization.encode()).hexdigest())
+
+    def is_pinned(self, request):
+        if PIN_COOKIE in request.COOKIES:
+            return True
+        key = self.get_pin_key(request)
+        return key is not None and cache.get(key) is not None
+
+    def pin(self, request, response):
+        timeout = settings.DB_REPLICA_PIN_SECONDS
+        response.set_cookie(
+            PIN_COOKIE, '1', max_age=timeout, httponly=True, samesite='Lax'
+        )
+        key = self.get_pin_key(request)
+        if key is not None:
+            cache.set(key, 1, timeout)
@@ -1,7 +1,157 @@
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from copy import copy
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class UserPagination(PageNumberPagination):
     page_size = settings.PAGE_LIMIT
     page_size_query_param = 'limit'
+
+
+class KeysetPagination(UserPagination):
+    # Постраничная навигация по курсору включается параметром ?cursor=
+    # (пустое значение - первая страница), без него работает
+    # обычная навигация по номеру страницы.
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering = ('-created', '-id')
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.fields = [
+            self.get_field(queryset, field.lstrip('-'))
+            for field in self.get_ordering(queryset)
+        ]
+        position, reverse = self.decode_cursor(
+            request.query_params[self.cursor_query_param]
+        )
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'estimate':
+            self.count = self.estimate_count(queryset)
+        ordering = self.get_ordering(queryset)
+        if reverse:
+            ordering = [self.reverse_field(field) for field in ordering]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(
+                self.keyset_filter(ordering, position)
+            )
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+        has_next = has_more if not reverse else position is not None
+        has_previous = has_more if reverse else position is not None
+        self.next_position = None
+        self.previous_position = None
+        if results and has_next:
+            self.next_position = self.get_position(results[-1])
+        if results and has_previous:
+            self.previous_position = self.get_position(results[0])
+        return results
+
+    def get_ordering(self, queryset):
+        # Явная сортировка queryset (например, по рейтингу) имеет приоритет,
+        # последним полем в ней должен идти уникальный id.
+        return tuple(queryset.query.order_by) or self.ordering
+
+    def get_field(self, queryset, name):
+        if name not in queryset.query.annotations:
+            return queryset.model._meta.get_field(name)
+        # Сортировка по аннотации (например, релевантности поиска).
+        field = copy(queryset.query.annotations[name].output_field)
+        field.set_attributes_from_name(name)
+        return field
+
+    def reverse_field(self, field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    def keyset_filter(self, ordering, position):
+        condition = Q()
+        for index, field in enumerate(ordering):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            step = Q(**{f'{field.lstrip("-")}__{lookup}': position[index]})
+            for previous, value in zip(ordering[:index], position):
+                step &= Q(**{previous.lstrip('-'): value})
+            condition |= step
+        return condition
+
+    def get_position(self, instance):
+        return [field.value_to_string(instance) for field in self.fields]
+
+    def encode_cursor(self, position, reverse):
+        cursor = json.dumps({'p': position, 'r': reverse})
+        return b64encode(cursor.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None, False
+        try:
+            cursor = json.loads(b64decode(cursor.encode()).decode())
+            position = [
+                field.to_python(value)
+                for field, value in zip(self.fields, cursor['p'])
+            ]
+            if len(position) != len(self.fields):
+                raise ValueError
+            return position, bool(cursor.get('r'))
+        except (ValueError, TypeError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def estimate_count(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return queryset.count()
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+    def get_cursor_link(self, position, reverse):
+        if position is None:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(),
+            self.page_query_param
+        )
+        return replace_query_param(
+            url,
+            self.cursor_query_param,
+            self.encode_cursor(position, reverse)
+        )
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_cursor_link(self.next_position, False)
+        response['previous'] = self.get_cursor_link(
+            self.previous_position, True
+        )
+        response['results'] = data
+        return Response(response)
+
+
+class SubscriptionPagination(KeysetPagination):
+    ordering = ('id',)
@@ -0,0 +1,125 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+
+from django.core.cache import cache
+from recipes.models import IngredientAmount
+
+RECIPE_INDEX_SEQUENCE_KEY = 'api:recipe_index:sequence'
+RECIPE_INDEX_CHANGES_KEY = 'api:recipe_index:changes:{}'
+RECIPE_INDEX_CHANGES_TIMEOUT = 60 * 60
+MAX_INCREMENTAL_CHANGES = 1000
+
+
+def get_sequence():
+    return cache.get(RECIPE_INDEX_SEQUENCE_KEY, 0)
+
+
+def record_recipe_changes(recipe_ids):
+    # Номер изменения растёт монотонно. Если счётчик пропал из кэша, он
+    # начинается заново с текущего времени, и разрыв в номерах заставит
+    # процессы перестроить индекс целиком.
+    try:
+        sequence = cache.incr(RECIPE_INDEX_SEQUENCE_KEY)
+    except ValueError:
+        cache.add(RECIPE_INDEX_SEQUENCE_KEY, int(time.time()), None)
+        sequence = cache.incr(RECIPE_INDEX_SEQUENCE_KEY)
+    cache.set(
+        RECIPE_INDEX_CHANGES_KEY.format(sequence),
+        list(recipe_ids),
+        RECIPE_INDEX_CHANGES_TIMEOUT
+    )
+
+
+def load_ingredients(recipe_ids=None):
+    amounts = IngredientAmount.objects.all()
+    if recipe_ids is not None:
+        amounts = amounts.filter(recipe_id__in=recipe_ids)
+    recipes = defaultdict(set)
+    for recipe_id, ingredient_id in amounts.values_list(
+        'recipe_id', 'ingredient_id'
+    ).order_by().iterator():
+        recipes[recipe_id].add(ingredient_id)
+    return recipes
+
+
+class RecipeIngredientIndex:
+    """Обратный индекс: ингредиент -> отсортированные id рецептов."""
+
+    def __init__(self, recipes, sequence=None):
+        self.recipes = {}
+        self.postings = defaultdict(lambda: array('I'))
+        for recipe_id in sorted(recipes):
+            ingredient_ids = recipes[recipe_id]
+            self.recipes[recipe_id] = array('I', sorted(ingredient_ids))
+            for ingredient_id in ingredient_ids:
+                self.postings[ingredient_id].append(recipe_id)
+        self.sequence = sequence
+
+    def remove(self, recipe_id):
+        for ingredient_id in self.recipes.pop(recipe_id, ()):
+            posting = self.postings[ingredient_id]
+            position = bisect_left(posting, recipe_id)
+            if position < len(posting) and posting[position] == recipe_id:
+                del posting[position]
+
+    def add(self, recipe_id, ingredient_ids):
+        self.recipes[recipe_id] = array('I', sorted(ingredient_ids))
+        for ingredient_id in ingredient_ids:
+            insort(self.postings[ingredient_id], recipe_id)
+
+    def apply_changes(self, sequence):
+        """Догоняет индекс до номера sequence, False - нужна перестройка."""
+        if sequence == self.sequence:
+            return True
+        if (self.sequence is None
+                or not 0 < sequence - self.sequence
+                <= MAX_INCREMENTAL_CHANGES):
+            return False
+        keys = [
+            RECIPE_INDEX_CHANGES_KEY.format(number)
+            for number in range(self.sequence + 1, sequence + 1)
+        ]
+        changes = cache.get_many(keys)
+        if len(changes) != len(keys):
+            return False
+        recipe_ids = set().union(*changes.values())
+        recipes = load_ingredients(recipe_ids)
+        for recipe_id in recipe_ids:
+            self.remove(recipe_id)
+            if recipe_id in recipes:
+                self.add(recipe_id, recipes[recipe_id])
+        self.sequence = sequence
+        return True
+
+    def match(self, ingredient_ids, max_missing=None):
+        """
+        Рецепты, в которых есть хотя бы один из ингредиентов, в порядке
+        убывания доли имеющихся ингредиентов: (id, доля, не хватает).
+        """
+        hits = Counter()
+        for ingredient_id in set(ingredient_ids):
+            hits.update(self.postings.get(ingredient_id, ()))
+        matches = []
+        for recipe_id, count in hits.items():
+            required = len(self.recipes[recipe_id])
+            missing = required - count
+            if max_missing is None or missing <= max_missing:
+                matches.append((recipe_id, count / required, missing))
+        matches.sort(key=lambda match: (-match[1], match[2], -match[0]))
+        return matches
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def match_recipes(ingredient_ids, max_missing=None):
+    global _index
+    with _lock:
+        sequence = get_sequence()
+        if _index is None or not _index.apply_changes(sequence):
+            _index = RecipeIngredientIndex(load_ingredients(), sequence)
+        return _index.match(ingredient_ids, max_missing)
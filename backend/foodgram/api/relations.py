@@ -0,0 +1,54 @@
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from recipes.models import Favorite, ShoppingCart
+from users.models import Follow
+
+from .cache import bump_cache_version, get_cache_version
+
+RELATIONS_VERSION_KEY = 'api:relations:version:{}'
+
+UserRelations = namedtuple(
+    'UserRelations', ('following', 'favorites', 'shopping_cart')
+)
+NO_RELATIONS = UserRelations(frozenset(), frozenset(), frozenset())
+
+
+def load_user_relations(user_id):
+    version = get_cache_version(RELATIONS_VERSION_KEY.format(user_id))
+    key = f'api:relations:{user_id}:{version}'
+    relations = cache.get(key)
+    if relations is None:
+        relations = UserRelations(
+            frozenset(Follow.objects.filter(
+                user_id=user_id
+            ).values_list('author_id', flat=True)),
+            frozenset(Favorite.objects.filter(
+                user_id=user_id
+            ).values_list('recipe_id', flat=True)),
+            frozenset(ShoppingCart.objects.filter(
+                user_id=user_id
+            ).values_list('recipe_id', flat=True)),
+        )
+        cache.set(key, relations, settings.RELATIONS_CACHE_TIMEOUT)
+    return relations
+
+
+def get_user_relations(request):
+    """Подписки, избранное и корзина текущего пользователя.
+
+    Загружаются один раз за запрос, между запросами хранятся в кэше,
+    версия которого меняется при каждой записи.
+    """
+    if request is None or request.user.is_anonymous:
+        return NO_RELATIONS
+    relations = getattr(request, 'user_relations', None)
+    if relations is None:
+        relations = load_user_relations(request.user.id)
+        request.user_relations = relations
+    return relations
+
+
+def invalidate_user_relations(user_id):
+    bump_cache_version(RELATIONS_VERSION_KEY.format(user_id))
@@ -0,0 +1,32 @@
+import threading
+
+from django.conf import settings as djset
+
+_state = threading.local()
+
+
+def set_replica(alias):
+    _state.replica = alias
+
+
+def current_replica():
+    return getattr(_state, 'replica', None)
+
+
+class ReplicaRouter:
+    """
+    Чтение в безопасных запросах идёт на реплику, выбранную
+    ReplicaMiddleware, остальные запросы к базе - на основную базу.
+    """
+
+    def db_for_read(self, model, **hints):
+        return current_replica() or 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in djset.DB_REPLICAS
@@ -1,18 +1,24 @@
 from django.conf import settings as djset
 from django.contrib.auth.password_validation import validate_password
 from django.core import exceptions as django_exceptions
+from django.core.files.storage import default_storage
 from django.db import IntegrityError, transaction
-from django.shortcuts import get_object_or_404
+from django.db.models import F, Prefetch, Window
+from django.db.models.functions import RowNumber
 from djoser.conf import settings
-from drf_extra_fields.fields import Base64ImageField
 from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
-                            ShoppingCart, Tag)
+                            ShoppingCart, ShoppingListItem, Tag)
 from rest_framework import serializers
 from rest_framework.serializers import ValidationError
 from users.models import Follow, User
 
+from .fields import Base64ImageField
+from .fragments import RecipeFragmentListSerializer, RecipeFragmentMixin
+from .metrics import SerializerTimingMixin
+from .relations import get_user_relations
 
-class UserSerializer(serializers.ModelSerializer):
+
+class UserSerializer(SerializerTimingMixin, serializers.ModelSerializer):
     email = serializers.EmailField(
         required=True,
         allow_blank=False,
@@ -52,12 +58,8 @@ class UserSerializer(serializers.ModelSerializer):
         return data
 
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        if user.is_anonymous:
-            return False
-        return Follow.objects.filter(
-            author_id=obj.id, user_id=user.id
-        ).exists()
+        relations = get_user_relations(self.context.get('request'))
+        return obj.id in relations.following
 
 
 class UserCreateSerializer(serializers.ModelSerializer):
@@ -109,14 +111,15 @@ class UserCreateSerializer(serializers.ModelSerializer):
         return user
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(SerializerTimingMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Tag
         fields = '__all__'
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(SerializerTimingMixin,
+                           serializers.ModelSerializer):
 
     class Meta:
         model = Ingredient
@@ -124,28 +127,44 @@ class IngredientSerializer(serializers.ModelSerializer):
 
 
 class RecipeIngredientSerializer(serializers.ModelSerializer):
-    amount = serializers.SerializerMethodField()
+    id = serializers.ReadOnlyField(source='ingredient.id')
+    name = serializers.ReadOnlyField(source='ingredient.name')
+    measurement_unit = serializers.ReadOnlyField(
+        source='ingredient.measurement_unit'
+    )
 
     class Meta:
-        model = Ingredient
+        model = IngredientAmount
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
-    def get_amount(self, obj):
-        recipe_id = self.context.get('recipe_id')
-        ingredient_id = obj.id
-        ingredient_amount = get_object_or_404(
-            IngredientAmount,
-            ingredient_id=ingredient_id,
-            recipe_id=recipe_id
-        )
-        return ingredient_amount.amount
 
+class ImageRenditionsField(serializers.ReadOnlyField):
+    """Уменьшенные копии картинки: {формат: {ширина: url}}."""
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
 
-class FavoriteRecipeSerializer(serializers.ModelSerializer):
+    def to_representation(self, recipe):
+        request = self.context.get('request')
+        renditions = {}
+        for image_format, names in recipe.get_renditions().items():
+            renditions[image_format] = {}
+            for width, name in names.items():
+                url = default_storage.url(name)
+                if request is not None:
+                    url = request.build_absolute_uri(url)
+                renditions[image_format][width] = url
+        return renditions
+
+
+class FavoriteRecipeSerializer(SerializerTimingMixin,
+                               serializers.ModelSerializer):
+    image_renditions = ImageRenditionsField()
 
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_renditions', 'cooking_time')
 
 
 class CreateRecipeIngredientSerializer(serializers.ModelSerializer):
@@ -157,38 +176,74 @@ class CreateRecipeIngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'amount')
 
 
-class RecipeSerializer(serializers.ModelSerializer):
+class RecipeSerializer(SerializerTimingMixin, RecipeFragmentMixin,
+                       serializers.ModelSerializer):
     tags = TagSerializer(many=True, required=True)
     author = UserSerializer(required=True)
-    ingredients = serializers.SerializerMethodField()
+    ingredients = RecipeIngredientSerializer(
+        source='recipe_amount',
+        many=True,
+        read_only=True
+    )
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
+    image_renditions = ImageRenditionsField()
 
     class Meta:
         model = Recipe
         fields = ('id', 'tags', 'author', 'ingredients',
                   'is_favorited', 'is_in_shopping_cart',
-                  'name', 'image', 'text', 'cooking_time')
+                  'name', 'image', 'image_renditions', 'text',
+                  'cooking_time')
+        list_serializer_class = RecipeFragmentListSerializer
+
+    # Части ответа, которые не зависят от пользователя и кэшируются
+    # по рецепту (is_subscribed автора вычисляется отдельно).
+    fragment_fields = ('id', 'tags', 'author', 'ingredients', 'name',
+                       'image', 'image_renditions', 'text', 'cooking_time')
+
+    def get_fragment_prefetch(self):
+        return (
+            'author',
+            'tags',
+            Prefetch(
+                'recipe_amount',
+                queryset=IngredientAmount.objects.select_related('ingredient')
+            ),
+        )
+
+    def split_fragment(self, data):
+        fragment = super().split_fragment(data)
+        fragment['author'] = {
+            field: value for field, value in data['author'].items()
+            if field != 'is_subscribed'
+        }
+        return fragment
+
+    def merge_fragment(self, fragment, recipe):
+        data = super().merge_fragment(fragment, recipe)
+        relations = get_user_relations(self.context.get('request'))
+        data['author'] = dict(
+            data['author'],
+            is_subscribed=recipe.author_id in relations.following
+        )
+        return data
 
     def get_is_favorited(self, obj):
-        user = self.context.get('request').user
-        if user.is_anonymous:
-            return False
-        return Favorite.objects.filter(
-            recipe_id=obj.id, user_id=user.id
-        ).exists()
+        relations = get_user_relations(self.context.get('request'))
+        return obj.id in relations.favorites
 
     def get_is_in_shopping_cart(self, obj):
-        user = self.context.get('request').user
-        if user.is_anonymous:
-            return False
-        return ShoppingCart.objects.filter(
-            recipe_id=obj.id, user_id=user.id
-        ).exists()
+        relations = get_user_relations(self.context.get('request'))
+        return obj.id in relations.shopping_cart
+
 
-    def get_ingredients(self, obj):
-        return RecipeIngredientSerializer(obj.ingredients.all(), many=True,
-                                          context={'recipe_id': obj.id}).data
+class MatchedRecipeSerializer(RecipeSerializer):
+    coverage = serializers.FloatField(read_only=True)
+    missing = serializers.IntegerField(source='missing_count', read_only=True)
+
+    class Meta(RecipeSerializer.Meta):
+        fields = RecipeSerializer.Meta.fields + ('coverage', 'missing')
 
 
 class CreateRecipeSerializer(serializers.ModelSerializer):
@@ -200,69 +255,98 @@ class CreateRecipeSerializer(serializers.ModelSerializer):
         fields = ('ingredients', 'tags',
                   'image', 'name', 'text', 'cooking_time')
 
+    def validate(self, data):
+        ingredients_data = data.get('ingredients')
+        if ingredients_data is None:
+            return data
+        ingredients_ids = {item['id'] for item in ingredients_data}
+        if not ingredients_ids:
+            raise ValidationError({'errors': 'Нужно выбрать ингредиенты!'})
+        if len(ingredients_ids) != len(ingredients_data):
+            raise ValidationError(
+                {'errors': 'Нельзя добавлять одинаковые ингредиенты'}
+            )
+        missing_ids = ingredients_ids - set(Ingredient.objects.filter(
+            id__in=ingredients_ids
+        ).values_list('id', flat=True))
+        if missing_ids:
+            raise ValidationError({
+                'errors': 'Ингредиенты не найдены: {}'.format(
+                    ', '.join(map(str, sorted(missing_ids)))
+                )
+            })
+        return data
+
+    @transaction.atomic
     def create(self, validated_data):
         ingredients_data = validated_data.pop('ingredients')
         tags_data = validated_data.pop('tags')
-        ingredients_list = []
-        amount_list = []
-        for i in range(len(ingredients_data)):
-            if ingredients_data[i]['id'] in ingredients_list:
-                raise ValidationError(
-                    {'errors': 'Нельзя добавлять одинаковые ингредиенты'}
-                )
-            ingredients_list.append(ingredients_data[i]['id'])
-            amount_list.append(ingredients_data[i]['amount'])
-        ingredients = Ingredient.objects.filter(id__in=ingredients_list)
-        tags = Tag.objects.filter(name__in=tags_data)
         recipe = Recipe.objects.create(**validated_data)
-        recipe.tags.set(tags)
-        for j in range(len(ingredients_data)):
-            recipe.ingredients.add(
-                ingredients[j], through_defaults={
-                    'amount': amount_list[j]
-                    }
+        recipe.tags.set(tags_data)
+        IngredientAmount.objects.bulk_create(
+            IngredientAmount(
+                recipe=recipe,
+                ingredient_id=item['id'],
+                amount=item['amount']
             )
+            for item in ingredients_data
+        )
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        ingredients_data = validated_data.pop('ingredients')
-        tags_data = validated_data.pop('tags')
-        ingredients_list = []
-        amount_list = []
-        for i in range(len(ingredients_data)):
-            if ingredients_data[i]['id'] in ingredients_list:
-                raise ValidationError(
-                    {'errors': 'Нельзя добавлять одинаковые ингредиенты'}
-                )
-            ingredients_list.append(ingredients_data[i]['id'])
-            amount_list.append(ingredients_data[i]['amount'])
-        instance.ingredients.clear()
-        ingredients = Ingredient.objects.filter(id__in=ingredients_list)
-        tags = Tag.objects.filter(name__in=tags_data)
-        instance.image = validated_data.get('image', instance.image)
-        instance.name = validated_data.get('name', instance.name)
-        instance.text = validated_data.get('text', instance.text)
-        instance.cooking_time = validated_data.get(
-            'cooking_time',
-            instance.cooking_time
-        )
-        instance.tags.set(tags)
-        instance.save()
-        for j in range(len(ingredients_data)):
-            instance.ingredients.add(
-                ingredients[j], through_defaults={
-                    'amount': amount_list[j]
-                    }
+        ingredients_data = validated_data.pop('ingredients', None)
+        tags_data = validated_data.pop('tags', None)
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        # Счётчики обновляются через F(), сохранять их из памяти нельзя.
+        instance.save(update_fields=[
+            field.name for field in Recipe._meta.concrete_fields
+            if field.editable and not field.primary_key
+        ])
+        if tags_data is not None:
+            instance.tags.set(tags_data)
+        if ingredients_data is None:
+            return instance
+        amounts = {item['id']: item['amount'] for item in ingredients_data}
+        existing = {
+            ingredient_amount.ingredient_id: ingredient_amount
+            for ingredient_amount in instance.recipe_amount.all()
+        }
+        old_amounts = {
+            ingredient_id: ingredient_amount.amount
+            for ingredient_id, ingredient_amount in existing.items()
+        }
+        removed_ids = existing.keys() - amounts.keys()
+        if removed_ids:
+            # Удаление без сигналов: иначе каждая строка отдельно меняла бы
+            # списки покупок. Все изменения учитываются одним change_recipe
+            # ниже, индексы и кэши обновляет post_save рецепта.
+            removed = instance.recipe_amount.filter(
+                ingredient_id__in=removed_ids
+            )
+            removed._raw_delete(removed.db)
+        changed = []
+        for ingredient_id, amount in amounts.items():
+            ingredient_amount = existing.get(ingredient_id)
+            if ingredient_amount and ingredient_amount.amount != amount:
+                ingredient_amount.amount = amount
+                changed.append(ingredient_amount)
+        IngredientAmount.objects.bulk_update(changed, ['amount'])
+        IngredientAmount.objects.bulk_create(
+            IngredientAmount(
+                recipe=instance,
+                ingredient_id=ingredient_id,
+                amount=amount
             )
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in existing
+        )
+        ShoppingListItem.objects.change_recipe(
+            instance.id, old_amounts, amounts
+        )
         return instance
 
-    def get_ingredients(self, obj):
-        return CreateRecipeIngredientSerializer(
-            self.data.get('ingredients'),
-            many=True,
-            context={'recipe_id': obj.id}
-        ).data
-
 
 class FavoriteSerializer(serializers.ModelSerializer):
     recipe = serializers.SerializerMethodField()
@@ -286,7 +370,8 @@ class ShoppingCartSerializer(serializers.ModelSerializer):
         return obj.id
 
 
-class SubscriptionSerializer(serializers.ModelSerializer):
+class SubscriptionSerializer(SerializerTimingMixin,
+                             serializers.ModelSerializer):
     email = serializers.EmailField(source='author.email', required=False)
     id = serializers.IntegerField(source='author.id', required=False)
     username = serializers.CharField(
@@ -324,22 +409,61 @@ class SubscriptionSerializer(serializers.ModelSerializer):
             raise ValidationError({'errors': 'Нельзя подписываться на себя!'})
         return data
 
+    @staticmethod
+    def get_recipes_limit(request):
+        limit = request.query_params.get('recipes_limit')
+        if limit is None:
+            return djset.PAGE_LIMIT
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = -1
+        if not 0 <= limit <= djset.RECIPES_LIMIT_MAX:
+            raise ValidationError({
+                'recipes_limit': 'Допустимо целое число от 0 до {}'.format(
+                    djset.RECIPES_LIMIT_MAX
+                )
+            })
+        return limit
+
+    @staticmethod
+    def prefetch_recipes(follows, limit):
+        recipes = {follow.author_id: [] for follow in follows}
+        if recipes and limit:
+            ranked = Recipe.objects.filter(
+                author_id__in=recipes
+            ).annotate(recipe_rank=Window(
+                expression=RowNumber(),
+                partition_by=[F('author_id')],
+                order_by=[F('created').desc(), F('id').desc()]
+            )).values(
+                'id', 'author_id', 'name', 'image', 'image_renditions',
+                'cooking_time', 'recipe_rank'
+            )
+            sql, params = ranked.query.sql_with_params()
+            for recipe in Recipe.objects.raw(
+                f'SELECT * FROM ({sql}) ranked WHERE recipe_rank <= %s',
+                (*params, limit)
+            ):
+                recipes[recipe.author_id].append(recipe)
+        for follow in follows:
+            follow.author_recipes = sorted(
+                recipes[follow.author_id],
+                key=lambda recipe: recipe.recipe_rank
+            )
+
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        if user.is_anonymous:
-            return False
-        return Follow.objects.filter(
-            author_id=obj.id, user_id=user.id
-        ).exists()
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
+        relations = get_user_relations(self.context.get('request'))
+        return obj.author_id in relations.following
 
     def get_recipes(self, obj):
-        limit = self.context.get('request').query_params.get('recipes_limit')
-        if limit is not None:
-            limit = int(limit)
-        else:
-            limit = djset.PAGE_LIMIT
-        queryset = obj.author.recipes.all()[:limit]
-        return FavoriteRecipeSerializer(queryset, many=True).data
+        if not hasattr(obj, 'author_recipes'):
+            self.prefetch_recipes(
+                [obj], self.get_recipes_limit(self.context.get('request'))
+            )
+        return FavoriteRecipeSerializer(obj.author_recipes, many=True).data
 
     def get_recipes_count(self, obj):
-        return obj.author.recipes.all().count()
+        return obj.author.recipes_count
@@ -0,0 +1,316 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_save)
+from django.dispatch import receiver
+from recipes.images import schedule_renditions
+from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
+                            ShoppingCart, ShoppingListItem, Tag)
+from recipes.search import update_search_index
+from recipes.signals import ingredients_imported, renditions_ready
+from users.models import Follow, User
+
+from .cache import bump_cache_version
+from .fragments import (invalidate_all_fragments, invalidate_author_fragments,
+                        invalidate_recipe_fragments)
+from .ingredient_index import INGREDIENTS_VERSION_KEY
+from .recipe_index import record_recipe_changes
+from .relations import invalidate_user_relations
+
+PUBLIC_USER_FIELDS = {'email', 'username', 'first_name', 'last_name'}
+# Модель-источник: (модель со счётчиком, поле связи, счётчик).
+COUNTERS = {
+    Favorite: (Recipe, 'recipe', 'favorites_count'),
+    ShoppingCart: (Recipe, 'recipe', 'in_carts_count'),
+    Recipe: (User, 'author', 'recipes_count'),
+    Follow: (User, 'author', 'followers_count'),
+}
+
+
+def on_commit_once(func):
+    # Каскадное удаление и правки в админке присылают сигнал на каждую
+    # строку, а сбросить кэш после коммита достаточно один раз.
+    connection = transaction.get_connection()
+    if all(callback != func for _, callback in connection.run_on_commit):
+        transaction.on_commit(func)
+
+
+class RecipeChanges:
+    """
+    Рецепты, изменённые в транзакции: поисковый индекс, фрагменты
+    и индекс ингредиентов обновляются одним вызовом после коммита.
+    """
+
+    def __init__(self):
+        self.recipe_ids = set()
+        self.search_ids = set()
+
+    def __call__(self):
+        if self.search_ids:
+            update_search_index(Recipe, sorted(self.search_ids))
+        invalidate_recipe_fragments(sorted(self.recipe_ids))
+        record_recipe_changes(sorted(self.recipe_ids))
+
+
+def schedule_recipe_changes(recipe_ids, search=True):
+    connection = transaction.get_connection()
+    changes = next((
+        callback for _, callback in connection.run_on_commit
+        if isinstance(callback, RecipeChanges)
+    ), None)
+    scheduled = changes is not None
+    if not scheduled:
+        changes = RecipeChanges()
+    changes.recipe_ids.update(recipe_ids)
+    if search:
+        changes.search_ids.update(recipe_ids)
+    # Вне транзакции on_commit вызывает функцию сразу, поэтому она
+    # регистрируется, когда id уже добавлены.
+    if not scheduled:
+        transaction.on_commit(changes)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_response_cache(sender, **kwargs):
+    on_commit_once(bump_cache_version)
+
+
+def changes_public_user_fields(update_fields):
+    # Вход в систему сохраняет только last_login, смена пароля - password:
+    # в ответах API эти поля не участвуют.
+    return not update_fields or bool(
+        set(update_fields) & PUBLIC_USER_FIELDS
+    )
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_response_cache(sender, **kwargs):
+    if changes_public_user_fields(kwargs.get('update_fields')):
+        transaction.on_commit(bump_cache_version)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_ingredient_index(sender, **kwargs):
+    transaction.on_commit(
+        lambda: bump_cache_version(INGREDIENTS_VERSION_KEY)
+    )
+
+
+def schedule_search_index_update(recipe_ids):
+    transaction.on_commit(lambda: update_search_index(Recipe, recipe_ids))
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def update_recipe_changes(sender, instance, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    # Индексы обновляются после коммита, когда ингредиенты рецепта
+    # уже сохранены: они пишутся через bulk_create без сигналов.
+    schedule_recipe_changes(
+        [instance.pk],
+        search=not update_fields or bool({'name', 'text'} & set(update_fields))
+    )
+
+
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+def update_ingredient_amount_changes(sender, instance, **kwargs):
+    schedule_recipe_changes([instance.recipe_id])
+
+
+@receiver(post_save, sender=Ingredient)
+def update_ingredient_search_index(sender, instance, created, **kwargs):
+    if not created:
+        schedule_search_index_update(list(
+            Recipe.objects.filter(ingredients=instance).values_list(
+                'id', flat=True
+            )
+        ))
+
+
+@receiver(ingredients_imported)
+def update_imported_ingredients(sender, updated_ids, **kwargs):
+    bump_cache_version(INGREDIENTS_VERSION_KEY)
+    bump_cache_version()
+    if not updated_ids:
+        return
+    # Переименованные ингредиенты меняют фрагменты и поисковый индекс
+    # рецептов, в которых они используются.
+    invalidate_all_fragments()
+    update_search_index(Recipe, list(
+        Recipe.objects.filter(ingredients__in=updated_ids).values_list(
+            'id', flat=True
+        ).distinct()
+    ))
+
+
+@receiver(post_save, sender=Recipe)
+def update_recipe_renditions(sender, instance, **kwargs):
+    if instance.image and not instance.get_renditions():
+        transaction.on_commit(lambda: schedule_renditions(instance.pk))
+
+
+@receiver(renditions_ready)
+def invalidate_recipe_renditions(sender, recipe_id, **kwargs):
+    # Готовые копии меняют ответы API, поэтому сбрасываем их кэш.
+    bump_cache_version()
+    invalidate_recipe_fragments([recipe_id])
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_tags_fragments(sender, instance, action, reverse,
+                                     pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        recipe_ids = [instance.pk]
+    elif pk_set is not None:
+        recipe_ids = list(pk_set)
+    else:
+        # Очистка рецептов у тега: затронутые рецепты уже неизвестны.
+        transaction.on_commit(invalidate_all_fragments)
+        return
+    transaction.on_commit(lambda: invalidate_recipe_fragments(recipe_ids))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_shared_fragments(sender, **kwargs):
+    on_commit_once(invalidate_all_fragments)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_author_fragment(sender, instance, **kwargs):
+    if not changes_public_user_fields(kwargs.get('update_fields')):
+        return
+    author_id = instance.pk
+    transaction.on_commit(lambda: invalidate_author_fragments(author_id))
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_delete, sender=ShoppingCart)
+def update_user_relations(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_user_relations(instance.user_id))
+
+
+# Список покупок меняется по сигналам, поэтому учитываются и правки
+# в админке, и каскадное удаление. Каждый обработчик берёт текущее
+# состояние другой таблицы: при каскадном удалении рецепта пара
+# (корзина, ингредиент) вычитается ровно один раз, когда удаляется
+# первая из двух строк. bulk_create и bulk_update сигналов не отправляют,
+# их изменения учитывает вызывающий код.
+@receiver(pre_save, sender=ShoppingCart)
+@receiver(pre_save, sender=IngredientAmount)
+def remember_saved_row(sender, instance, **kwargs):
+    instance.saved_row = (
+        sender.objects.filter(pk=instance.pk).first()
+        if instance.pk is not None else None
+    )
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_shopping_list_recipe(sender, instance, **kwargs):
+    old = getattr(instance, 'saved_row', None)
+    if old is not None:
+        if (old.user_id, old.recipe_id) == (instance.user_id,
+                                            instance.recipe_id):
+            return
+        ShoppingListItem.objects.remove_recipe([old.user_id], old.recipe_id)
+    ShoppingListItem.objects.add_recipe(
+        [instance.user_id], instance.recipe_id
+    )
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def remove_shopping_list_recipe(sender, instance, **kwargs):
+    ShoppingListItem.objects.remove_recipe(
+        [instance.user_id], instance.recipe_id
+    )
+
+
+@receiver(post_save, sender=IngredientAmount)
+def change_shopping_list_amount(sender, instance, **kwargs):
+    old = getattr(instance, 'saved_row', None)
+    old_amounts = {}
+    if old is not None and old.recipe_id != instance.recipe_id:
+        ShoppingListItem.objects.change_recipe(
+            old.recipe_id, {old.ingredient_id: old.amount}, {}
+        )
+    elif old is not None:
+        old_amounts = {old.ingredient_id: old.amount}
+    ShoppingListItem.objects.change_recipe(
+        instance.recipe_id, old_amounts,
+        {instance.ingredient_id: instance.amount}
+    )
+
+
+@receiver(post_delete, sender=IngredientAmount)
+def remove_shopping_list_amount(sender, instance, **kwargs):
+    ShoppingListItem.objects.change_recipe(
+        instance.recipe_id, {instance.ingredient_id: instance.amount}, {}
+    )
+
+
+# Счётчики, как и список покупок, меняются по сигналам: их не сбивают
+# правки в админке и каскадное удаление. Расхождения, оставленные
+# bulk-операциями, исправляет команда reconcile_counters.
+def change_counter(sender, owner_id, delta):
+    model, _, counter = COUNTERS[sender]
+    model.objects.filter(pk=owner_id).update(**{counter: F(counter) + delta})
+
+
+@receiver(pre_save, sender=Favorite)
+@receiver(pre_save, sender=ShoppingCart)
+@receiver(pre_save, sender=Recipe)
+@receiver(pre_save, sender=Follow)
+def remember_counter_owner(sender, instance, update_fields=None, **kwargs):
+    _, field, _ = COUNTERS[sender]
+    instance.saved_owner_id = None
+    if instance.pk is not None and (
+        update_fields is None
+        or {field, f'{field}_id'} & set(update_fields)
+    ):
+        instance.saved_owner_id = sender.objects.filter(
+            pk=instance.pk
+        ).values_list(field, flat=True).first()
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Follow)
+def increment_counter(sender, instance, created, **kwargs):
+    _, field, _ = COUNTERS[sender]
+    owner_id = getattr(instance, f'{field}_id')
+    old_owner_id = getattr(instance, 'saved_owner_id', None)
+    if not created and old_owner_id in (None, owner_id):
+        return
+    if old_owner_id is not None:
+        change_counter(sender, old_owner_id, -1)
+    change_counter(sender, owner_id, 1)
+
+
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Follow)
+def decrement_counter(sender, instance, **kwargs):
+    _, field, _ = COUNTERS[sender]
+    change_counter(sender, getattr(instance, f'{field}_id'), -1)
@@ -0,0 +1,983 @@
+import binascii
+import os
+import tempfile
+from base64 import b64encode
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.db.models.functions import Lower
+from django.db.utils import ConnectionHandler
+from django.test import (SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
+                            ShoppingCart, Tag)
+from recipes.search import update_search_index
+from recipes.storage import ContentAddressedStorage
+from rest_framework.test import APIClient
+from users.models import Follow, User
+
+from . import ingredient_index, recipe_index
+from .cache import bump_cache_version, get_cache_version
+from .fields import BASE64_CHUNK_SIZE, Base64ImageField
+from .filters import IngredientFilter
+from .fragments import FRAGMENTS_VERSION_KEY, RECIPE_VERSION_KEY
+from .ingredient_index import INGREDIENTS_VERSION_KEY
+from .views import RecipeViewSet
+
+LOCAL_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+def create_user(number):
+    return User.objects.create_user(
+        username=f'user{number}', email=f'user{number}@example.com',
+        first_name='Имя', last_name='Фамилия', password='password'
+    )
+
+
+def use_temporary_media(test):
+    media = tempfile.TemporaryDirectory()
+    test.addCleanup(media.cleanup)
+    media_settings = override_settings(MEDIA_ROOT=media.name)
+    media_settings.enable()
+    test.addCleanup(media_settings.disable)
+    return media.name
+
+
+def image_data(size=(32, 32), image_format='PNG'):
+    output = BytesIO()
+    Image.new('RGB', size, 'red').save(output, image_format)
+    return (f'data:image/{image_format.lower()};base64,'
+            + b64encode(output.getvalue()).decode())
+
+
+def create_recipe(author, tags, ingredients):
+    recipe = Recipe.objects.create(
+        author=author, name='Рецепт', text='Описание', cooking_time=10
+    )
+    recipe.tags.set(tags)
+    IngredientAmount.objects.bulk_create(
+        IngredientAmount(recipe=recipe, ingredient=ingredient, amount=100)
+        for ingredient in ingredients
+    )
+    return recipe
+
+
+@override_settings(IMAGE_RENDITION_WORKERS=0, CACHES=LOCAL_CACHES)
+class QueryCountTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user(0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tags = [
+            Tag.objects.create(name=f'Тег {number}', slug=f'tag{number}',
+                               color=f'#00000{number}')
+            for number in range(3)
+        ]
+        self.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {number}',
+                                      measurement_unit='г')
+            for number in range(5)
+        ]
+
+    def count_queries(self, path, params=None):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return len(context)
+
+    def add_authors(self, count, recipes_per_author):
+        for number in range(count):
+            author = create_user(len(User.objects.all()))
+            Follow.objects.create(user=self.user, author=author)
+            for _ in range(recipes_per_author):
+                create_recipe(author, self.tags, self.ingredients)
+
+
+class RecipeQueryTest(QueryCountTestCase):
+    def add_recipes(self, count):
+        return [
+            create_recipe(create_user(len(User.objects.all())),
+                          self.tags, self.ingredients)
+            for _ in range(count)
+        ]
+
+    def test_list_queries_do_not_grow_with_page_size(self):
+        self.add_recipes(2)
+        small = self.count_queries('/api/recipes/')
+        self.add_recipes(6)
+        self.assertEqual(self.count_queries('/api/recipes/'), small)
+
+    def test_anonymous_list_queries_do_not_grow_with_page_size(self):
+        self.client.force_authenticate(None)
+        self.add_recipes(2)
+        small = self.count_queries('/api/recipes/')
+        self.add_recipes(6)
+        self.assertEqual(self.count_queries('/api/recipes/'), small)
+
+    def test_detail_queries_do_not_grow_with_ingredients(self):
+        author = create_user(1)
+        small = create_recipe(author, self.tags[:1], self.ingredients[:1])
+        large = create_recipe(author, self.tags, self.ingredients)
+        self.assertEqual(
+            self.count_queries(f'/api/recipes/{small.id}/'),
+            self.count_queries(f'/api/recipes/{large.id}/')
+        )
+
+
+class UserQueryTest(QueryCountTestCase):
+    def test_list_queries_do_not_grow_with_page_size(self):
+        self.add_authors(2, 0)
+        small = self.count_queries('/api/users/')
+        self.add_authors(6, 0)
+        self.assertEqual(self.count_queries('/api/users/'), small)
+
+
+class SubscriptionQueryTest(QueryCountTestCase):
+    def test_queries_do_not_grow_with_recipes_limit(self):
+        self.add_authors(4, 3)
+        counts = [
+            self.count_queries(
+                '/api/users/subscriptions/', {'recipes_limit': limit}
+            )
+            for limit in (1, 3)
+        ]
+        self.assertEqual(counts[0], counts[1])
+
+    def test_queries_do_not_grow_with_authors(self):
+        self.add_authors(2, 2)
+        small = self.count_queries('/api/users/subscriptions/')
+        self.add_authors(4, 2)
+        self.assertEqual(
+            self.count_queries('/api/users/subscriptions/'), small
+        )
+
+
+class RecipeWriteQueryTest(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        use_temporary_media(self)
+        self.ingredients += [
+            Ingredient.objects.create(name=f'Ингредиент {number}',
+                                      measurement_unit='г')
+            for number in range(len(self.ingredients), 100)
+        ]
+        self.buyer = create_user(1)
+
+    def write(self, method, path, data):
+        response = getattr(self.client, method)(path, data, format='json')
+        self.assertIn(response.status_code, (200, 201), response.data)
+
+    def add_to_cart(self, recipe):
+        # Изменения рецепта в корзине пересчитывают список покупок.
+        ShoppingCart.objects.create(user=self.buyer, recipe=recipe)
+
+    def amounts(self, ingredients, amount):
+        return [
+            {'id': ingredient.id, 'amount': amount}
+            for ingredient in ingredients
+        ]
+
+    def assertConstantQueries(self, prepare):
+        # Первый запрос заполняет кэши пользователя и справочников.
+        self.write(*prepare(1))
+        with CaptureQueriesContext(connection) as context:
+            self.write(*prepare(5))
+        with self.assertNumQueries(len(context)):
+            self.write(*prepare(50))
+
+    def test_create(self):
+        self.assertConstantQueries(lambda count: ('post', '/api/recipes/', {
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 10,
+            'tags': [self.tags[0].id], 'image': image_data(),
+            'ingredients': self.amounts(self.ingredients[:count], 10),
+        }))
+
+    def test_update_changed_amounts(self):
+        def prepare(count):
+            recipe = create_recipe(
+                self.user, self.tags, self.ingredients[:count]
+            )
+            self.add_to_cart(recipe)
+            return 'patch', f'/api/recipes/{recipe.id}/', {
+                'ingredients': self.amounts(self.ingredients[:count], 7),
+            }
+        self.assertConstantQueries(prepare)
+
+    def test_update_removed_ingredients(self):
+        def prepare(count):
+            recipe = create_recipe(
+                self.user, self.tags, self.ingredients[:count + 1]
+            )
+            self.add_to_cart(recipe)
+            return 'patch', f'/api/recipes/{recipe.id}/', {
+                'ingredients': self.amounts(
+                    self.ingredients[count:count + 1], 7
+                ),
+            }
+        self.assertConstantQueries(prepare)
+
+    def test_removed_ingredients_leave_shopping_list_consistent(self):
+        recipe = create_recipe(self.user, self.tags, self.ingredients[:10])
+        self.add_to_cart(recipe)
+        self.write('patch', f'/api/recipes/{recipe.id}/', {
+            'ingredients': self.amounts(self.ingredients[8:12], 3),
+        })
+        self.assertEqual(
+            set(recipe.recipe_amount.values_list('ingredient_id', flat=True)),
+            {ingredient.id for ingredient in self.ingredients[8:12]}
+        )
+        call_command('rebuild_shopping_list', check=True, stdout=StringIO())
+
+
+class QueryPlanTest(TestCase):
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # На маленькой таблице планировщик выбрал бы полный просмотр,
+            # проверяем, что индекс вообще подходит к запросу.
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        self.user = create_user(0)
+
+    def assertUsesIndex(self, queryset, *names):
+        plan = queryset.explain()
+        self.assertTrue(any(name in plan for name in names), plan)
+
+    def test_recipe_list_uses_created_index(self):
+        self.assertUsesIndex(
+            RecipeViewSet().get_queryset()[:6], 'recipe_created_idx'
+        )
+
+    def test_shopping_cart_lookup_uses_unique_index(self):
+        self.assertUsesIndex(
+            ShoppingCart.objects.filter(user=self.user, recipe_id=1),
+            'unique_shopping_cart', 'sqlite_autoindex_recipes_shoppingcart'
+        )
+
+    def test_ingredient_import_lookup_uses_lower_index(self):
+        self.assertUsesIndex(
+            Ingredient.objects.annotate(
+                lower_name=Lower('name')
+            ).filter(lower_name__in=['соль']),
+            'recipes_ingredient_name_lower'
+        )
+
+    @skipUnless(connection.vendor == 'postgresql',
+                'индекс text_pattern_ops есть только в PostgreSQL')
+    def test_ingredient_search_uses_prefix_index(self):
+        queryset = IngredientFilter(
+            {'name': 'со'}, queryset=Ingredient.objects.all()
+        ).qs
+        self.assertUsesIndex(queryset, 'recipes_ingredient_name_upper_like')
+
+
+class ConnectionReuseTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'db.sqlite3')
+
+    def count_connections(self, conn_max_age, requests=3):
+        # Тестовая база SQLite в памяти никогда не закрывается,
+        # поэтому соединения считаются на отдельной базе в файле.
+        handler = ConnectionHandler({'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': self.path,
+            'CONN_MAX_AGE': conn_max_age,
+        }})
+        created = []
+
+        def count(sender, connection, **kwargs):
+            if connection.settings_dict['NAME'] == self.path:
+                created.append(connection)
+
+        connection_created.connect(count)
+        self.addCleanup(connection_created.disconnect, count)
+        with mock.patch('django.db.connections', handler), \
+                mock.patch('api.connections.connections', handler):
+            for _ in range(requests):
+                request_started.send(
+                    sender=self.__class__, environ={'REQUEST_METHOD': 'GET'}
+                )
+                with handler['default'].cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                request_finished.send(sender=self.__class__)
+        handler.close_all()
+        return len(created)
+
+    def test_persistent_connection_is_reused(self):
+        self.assertEqual(self.count_connections(60), 1)
+
+    def test_connection_is_closed_without_max_age(self):
+        self.assertEqual(self.count_connections(0), 3)
+
+
+@skipUnless(connection.settings_dict['ENGINE'] == 'api.backends.postgresql',
+            'ленивая проверка соединений есть только в своём бэкенде')
+class ConnectionHealthCheckTest(TransactionTestCase):
+    def test_connection_is_checked_on_first_use(self):
+        connection.ensure_connection()
+        with mock.patch.object(type(connection), 'is_usable',
+                               return_value=True) as is_usable:
+            connection.close_if_unusable_or_obsolete()
+            self.assertFalse(is_usable.called)
+            Tag.objects.count()
+            Tag.objects.count()
+        self.assertEqual(is_usable.call_count, 1)
+
+    def test_broken_connection_is_reopened(self):
+        connection.ensure_connection()
+        broken = connection.connection
+        with mock.patch.object(type(connection), 'is_usable',
+                               return_value=False):
+            connection.close_if_unusable_or_obsolete()
+            Tag.objects.count()
+        self.assertIsNot(connection.connection, broken)
+
+
+@override_settings(CACHES=LOCAL_CACHES, DB_REPLICAS=['replica_0'])
+class ReplicaRoutingTest(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        # Вторая база SQLite играет роль реплики, в ней только теги.
+        connections.databases['replica_0'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.directory.name, 'replica.sqlite3'),
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica_0'].close()
+        del connections.databases['replica_0']
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        with connections['replica_0'].schema_editor() as editor:
+            editor.create_model(Tag)
+        self.addCleanup(self.drop_replica_tags)
+        Tag.objects.using('replica_0').create(
+            name='Реплика', slug='replica', color='#000001'
+        )
+        Tag.objects.create(name='Основная', slug='primary', color='#000002')
+        self.user = create_user(0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def drop_replica_tags(self):
+        with connections['replica_0'].schema_editor() as editor:
+            editor.delete_model(Tag)
+
+    def get_tag_slugs(self):
+        response = self.client.get('/api/tags/')
+        self.assertEqual(response.status_code, 200)
+        return [tag['slug'] for tag in response.data]
+
+    def test_safe_requests_read_from_replica(self):
+        self.assertEqual(self.get_tag_slugs(), ['replica'])
+
+    def test_client_is_pinned_to_primary_after_write(self):
+        recipe = create_recipe(create_user(1), [], [])
+        response = self.client.post(f'/api/recipes/{recipe.id}/favorite/')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(self.get_tag_slugs(), ['primary'])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class RefreshScoresTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(create_user(0))
+        author = create_user(1)
+        self.recipe = create_recipe(author, [], [])
+        self.other = create_recipe(author, [], [])
+
+    def refresh(self):
+        with CaptureQueriesContext(connection) as context:
+            call_command('refresh_scores', stdout=StringIO())
+        self.recipe.refresh_from_db()
+        return [
+            query['sql'] for query in context
+            if query['sql'].startswith('UPDATE')
+        ]
+
+    def test_removed_favorite_lowers_trending(self):
+        path = f'/api/recipes/{self.recipe.id}/favorite/'
+        self.assertEqual(self.client.post(path).status_code, 201)
+        self.refresh()
+        self.assertEqual(self.recipe.popular_score, 2)
+        self.assertGreater(self.recipe.trending_score, 0)
+        self.assertEqual(self.client.delete(path).status_code, 204)
+        self.refresh()
+        self.assertEqual(self.recipe.popular_score, 0)
+        self.assertEqual(self.recipe.trending_score, 0)
+
+    def test_only_changed_recipes_are_updated(self):
+        self.refresh()
+        self.assertEqual(self.refresh(), [])
+        self.client.post(f'/api/recipes/{self.recipe.id}/shopping_cart/')
+        updates = self.refresh()
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.recipe.popular_score, 1)
+
+
+@override_settings(IMAGE_RENDITION_WORKERS=0, CACHES=LOCAL_CACHES)
+class RecipeSearchTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        self.user = create_user(0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tag = Tag.objects.create(name='Тег', slug='tag', color='#000000')
+        self.ingredient = Ingredient.objects.create(
+            name='Шафран', measurement_unit='г'
+        )
+        self.salt = Ingredient.objects.create(name='Соль',
+                                              measurement_unit='г')
+        # Таблица FTS5 не очищается между тестами.
+        update_search_index(Recipe)
+
+    def create(self, name, text, ingredients=None):
+        response = self.client.post('/api/recipes/', {
+            'name': name, 'text': text, 'cooking_time': 10,
+            'tags': [self.tag.id], 'image': image_data(),
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 10}
+                for ingredient in ingredients or [self.salt]
+            ],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['id']
+
+    def search(self, query):
+        response = self.client.get('/api/recipes/', {'search': query})
+        self.assertEqual(response.status_code, 200, response.data)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_name_match_ranks_first(self):
+        in_text = self.create('Омлет', 'Подавать с пирогом')
+        in_name = self.create('Пирог', 'Печь в духовке')
+        self.create('Суп', 'Варить час')
+        self.assertEqual(self.search('пирог'), [in_name, in_text])
+
+    def test_matches_ingredient_name(self):
+        recipe_id = self.create('Плов', 'Варить', [self.ingredient])
+        self.create('Суп', 'Варить')
+        self.assertEqual(self.search('шафран'), [recipe_id])
+
+    def test_ingredient_rename_reindexes_recipes(self):
+        recipe_id = self.create('Плов', 'Варить', [self.ingredient])
+        self.ingredient.name = 'Куркума'
+        self.ingredient.save()
+        self.assertEqual(self.search('шафран'), [])
+        self.assertEqual(self.search('куркума'), [recipe_id])
+
+    def test_ingredient_change_reindexes_recipe(self):
+        recipe_id = self.create('Плов', 'Варить', [self.ingredient])
+        other = Ingredient.objects.create(name='Зира', measurement_unit='г')
+        response = self.client.patch(f'/api/recipes/{recipe_id}/', {
+            'ingredients': [{'id': other.id, 'amount': 5}],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.search('шафран'), [])
+        self.assertEqual(self.search('зира'), [recipe_id])
+
+    def test_list_does_not_load_search_vector(self):
+        self.create('Плов', 'Варить')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/api/recipes/')
+        self.assertFalse(any(
+            'search_vector' in query['sql'] for query in context
+        ))
+
+
+def noise_image_data(size):
+    output = BytesIO()
+    Image.effect_noise(size, 64).save(output, 'PNG')
+    return ('data:image/png;base64,'
+            + b64encode(output.getvalue()).decode())
+
+
+@override_settings(IMAGE_RENDITION_WORKERS=0, CACHES=LOCAL_CACHES)
+class Base64ImageFieldTest(TestCase):
+    def setUp(self):
+        self.media = use_temporary_media(self)
+        self.client = APIClient()
+        self.client.force_authenticate(create_user(0))
+        self.tag = Tag.objects.create(name='Тег', slug='tag', color='#000000')
+        self.ingredient = Ingredient.objects.create(name='Соль',
+                                                    measurement_unit='г')
+
+    def create(self, image):
+        return self.client.post('/api/recipes/', {
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 10,
+            'tags': [self.tag.id], 'image': image,
+            'ingredients': [{'id': self.ingredient.id, 'amount': 10}],
+        }, format='json')
+
+    def assertRejected(self, image):
+        response = self.create(image)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+        self.assertFalse(Recipe.objects.exists())
+
+    @override_settings(IMAGE_UPLOAD_MAX_BYTES=1024)
+    def test_oversized_payload(self):
+        self.assertRejected(noise_image_data((64, 64)))
+
+    @override_settings(IMAGE_UPLOAD_MAX_PIXELS=100 * 100)
+    def test_decompression_bomb(self):
+        # Однотонная картинка сжимается в сотни байт при любом размере.
+        self.assertRejected(image_data((4000, 4000)))
+
+    def test_disallowed_format(self):
+        self.assertRejected(image_data(image_format='BMP'))
+
+    def test_invalid_base64(self):
+        self.assertRejected('data:image/png;base64,не base64')
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_valid_upload_is_streamed_to_disk(self):
+        data = noise_image_data((256, 256))
+        with mock.patch('api.fields.binascii.a2b_base64',
+                        wraps=binascii.a2b_base64) as decode:
+            uploaded = Base64ImageField().to_internal_value(data)
+        self.addCleanup(uploaded.close)
+        # Строка декодируется по частям, а файл сразу уходит на диск.
+        self.assertGreater(decode.call_count, 1)
+        self.assertLessEqual(
+            max(len(call[0][0]) for call in decode.call_args_list),
+            BASE64_CHUNK_SIZE
+        )
+        self.assertTrue(uploaded.file._rolled)
+        response = self.create(data)
+        self.assertEqual(response.status_code, 200, response.data)
+        recipe = Recipe.objects.get()
+        self.assertTrue(recipe.image.path.startswith(self.media))
+        self.assertEqual(os.path.getsize(recipe.image.path), uploaded.size)
+
+
+@override_settings(IMAGE_RENDITION_WORKERS=0, CACHES=LOCAL_CACHES)
+class RecipeIndexTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        index = mock.patch.object(recipe_index, '_index', None)
+        index.start()
+        self.addCleanup(index.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(create_user(0))
+        self.tag = Tag.objects.create(name='Тег', slug='tag', color='#000000')
+        self.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {number}',
+                                      measurement_unit='г')
+            for number in range(3)
+        ]
+
+    def amounts(self, *ingredients):
+        return [
+            {'id': ingredient.id, 'amount': 10} for ingredient in ingredients
+        ]
+
+    def create(self, *ingredients):
+        response = self.client.post('/api/recipes/', {
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 10,
+            'tags': [self.tag.id], 'image': image_data(),
+            'ingredients': self.amounts(*ingredients),
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['id']
+
+    def update(self, recipe_id, *ingredients):
+        response = self.client.patch(f'/api/recipes/{recipe_id}/', {
+            'ingredients': self.amounts(*ingredients),
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def match(self, *ingredients):
+        response = self.client.get('/api/recipes/match/', {
+            'ingredients': ','.join(
+                str(ingredient.id) for ingredient in ingredients
+            )
+        })
+        self.assertEqual(response.status_code, 200, response.data)
+        return [
+            (recipe['id'], recipe['coverage'], recipe['missing'])
+            for recipe in response.data['results']
+        ]
+
+    def test_create(self):
+        first, second, _ = self.ingredients
+        self.assertEqual(self.match(first), [])
+        recipe_id = self.create(first, second)
+        self.assertEqual(self.match(first), [(recipe_id, 0.5, 1)])
+
+    def test_update(self):
+        first, second, _ = self.ingredients
+        recipe_id = self.create(first)
+        self.assertEqual(self.match(first), [(recipe_id, 1.0, 0)])
+        self.update(recipe_id, first, second)
+        self.assertEqual(self.match(first), [(recipe_id, 0.5, 1)])
+
+    def test_delete(self):
+        first, _, _ = self.ingredients
+        recipe_id = self.create(first)
+        self.assertEqual(self.match(first), [(recipe_id, 1.0, 0)])
+        response = self.client.delete(f'/api/recipes/{recipe_id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.match(first), [])
+
+    def test_ingredient_swap(self):
+        first, second, third = self.ingredients
+        recipe_id = self.create(first, second)
+        self.assertEqual(self.match(first), [(recipe_id, 0.5, 1)])
+        self.update(recipe_id, second, third)
+        self.assertEqual(self.match(first), [])
+        self.assertEqual(self.match(third), [(recipe_id, 0.5, 1)])
+
+    def test_sequence_gap_rebuilds_index(self):
+        first, _, _ = self.ingredients
+        recipe_id = self.create(first)
+        self.assertEqual(self.match(first), [(recipe_id, 1.0, 0)])
+        other = create_recipe(User.objects.get(), [], [first])
+        # Записей об изменениях больше, чем догоняется по журналу.
+        cache.incr(recipe_index.RECIPE_INDEX_SEQUENCE_KEY,
+                   recipe_index.MAX_INCREMENTAL_CHANGES + 1)
+        with mock.patch('api.recipe_index.load_ingredients',
+                        wraps=recipe_index.load_ingredients) as load:
+            matches = self.match(first)
+        load.assert_called_once_with()
+        self.assertEqual(matches, [(other.id, 1.0, 0), (recipe_id, 1.0, 0)])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ShoppingListTest(TestCase):
+    def setUp(self):
+        self.user = create_user(0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.author = create_user(1)
+        self.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {number}',
+                                      measurement_unit='г')
+            for number in range(3)
+        ]
+        self.recipes = [
+            create_recipe(self.author, [], self.ingredients[:2]),
+            create_recipe(self.author, [], self.ingredients[1:]),
+        ]
+        for recipe in self.recipes:
+            response = self.client.post(
+                f'/api/recipes/{recipe.id}/shopping_cart/'
+            )
+            self.assertEqual(response.status_code, 201, response.data)
+
+    def assertShoppingListConsistent(self):
+        call_command('rebuild_shopping_list', check=True, stdout=StringIO())
+
+    def test_cart_changes_update_shopping_list(self):
+        self.assertShoppingListConsistent()
+        self.client.delete(f'/api/recipes/{self.recipes[0].id}/shopping_cart/')
+        self.assertShoppingListConsistent()
+
+    def test_admin_amount_changes_update_shopping_list(self):
+        amount = IngredientAmount.objects.filter(recipe=self.recipes[0])[0]
+        amount.amount = 250
+        amount.save()
+        self.assertShoppingListConsistent()
+        amount.ingredient = self.ingredients[2]
+        amount.save()
+        self.assertShoppingListConsistent()
+        amount.delete()
+        self.assertShoppingListConsistent()
+        IngredientAmount.objects.create(
+            recipe=self.recipes[1], ingredient=self.ingredients[0], amount=5
+        )
+        self.assertShoppingListConsistent()
+
+    def test_admin_cart_changes_update_shopping_list(self):
+        cart = ShoppingCart.objects.get(recipe=self.recipes[0])
+        cart.user = self.author
+        cart.save()
+        self.assertShoppingListConsistent()
+        ShoppingCart.objects.create(user=self.author, recipe=self.recipes[1])
+        self.assertShoppingListConsistent()
+
+    def test_cascade_deletes_update_shopping_list(self):
+        self.recipes[0].delete()
+        self.assertShoppingListConsistent()
+        self.author.delete()
+        self.assertShoppingListConsistent()
+        self.assertFalse(self.user.shopping_list.exists())
+
+    def test_recipe_update_keeps_shopping_list(self):
+        self.client.force_authenticate(self.author)
+        response = self.client.patch(
+            f'/api/recipes/{self.recipes[0].id}/',
+            {'ingredients': [
+                {'id': self.ingredients[1].id, 'amount': 30},
+                {'id': self.ingredients[2].id, 'amount': 40},
+            ]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertShoppingListConsistent()
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CounterTest(TestCase):
+    def setUp(self):
+        self.users = [create_user(number) for number in range(3)]
+        self.recipes = [
+            create_recipe(author, [], []) for author in self.users[:2]
+        ]
+
+    def assertNoDrift(self):
+        call_command('reconcile_counters', check=True,
+                     stdout=StringIO())
+
+    def test_api_changes_keep_counters(self):
+        client = APIClient()
+        client.force_authenticate(self.users[2])
+        recipe, author = self.recipes[0], self.users[0]
+        for path in (f'/api/recipes/{recipe.id}/favorite/',
+                     f'/api/recipes/{recipe.id}/shopping_cart/',
+                     f'/api/users/{author.id}/subscribe/'):
+            self.assertEqual(client.post(path).status_code, 201)
+            self.assertEqual(client.post(path).status_code, 400)
+        recipe.refresh_from_db()
+        author.refresh_from_db()
+        self.assertEqual((recipe.favorites_count, recipe.in_carts_count),
+                         (1, 1))
+        self.assertEqual(author.followers_count, 1)
+        self.assertNoDrift()
+        response = client.delete(f'/api/users/{author.id}/subscribe/')
+        self.assertEqual(response.status_code, 204)
+        self.assertNoDrift()
+
+    def test_orm_changes_keep_counters(self):
+        first, second = self.recipes
+        user = self.users[2]
+        favorite = Favorite.objects.create(user=user, recipe=first)
+        ShoppingCart.objects.create(user=user, recipe=first)
+        Follow.objects.create(user=user, author=self.users[0])
+        self.assertNoDrift()
+        # Правки в админке: перенос на другой рецепт и другого автора.
+        favorite.recipe = second
+        favorite.save()
+        second.refresh_from_db()
+        second.author = self.users[2]
+        second.save()
+        self.assertNoDrift()
+        Favorite.objects.filter(user=user).delete()
+        # Каскадное удаление корзин и рецептов вместе с автором.
+        self.users[0].delete()
+        self.assertNoDrift()
+        self.assertEqual(
+            User.objects.get(pk=user.pk).recipes_count, 1
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class UserCacheInvalidationTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user(0)
+
+    def test_login_keeps_response_cache(self):
+        version = get_cache_version()
+        response = APIClient().post('/api/auth/token/login/', {
+            'email': self.user.email, 'password': 'password'
+        })
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(get_cache_version(), version)
+
+    def test_profile_change_invalidates_response_cache(self):
+        version = get_cache_version()
+        self.user.first_name = 'Другое'
+        self.user.save()
+        self.assertGreater(get_cache_version(), version)
+
+    def test_concurrent_bumps_get_distinct_versions(self):
+        get_cache_version()
+        get = cache.get
+        concurrent = []
+
+        def get_with_concurrent_bump(*args, **kwargs):
+            # Второй сброс успевает между чтением и записью первого.
+            value = get(*args, **kwargs)
+            if not concurrent:
+                concurrent.append(None)
+                concurrent[0] = bump_cache_version()
+            return value
+
+        with mock.patch.object(cache, 'get', get_with_concurrent_bump):
+            version = bump_cache_version()
+        self.assertNotEqual(version, concurrent[0])
+        self.assertEqual(get_cache_version(), max(version, concurrent[0]))
+        self.assertGreater(get_cache_version(), concurrent[0])
+
+
+@override_settings(CACHES=LOCAL_CACHES, IMAGE_RENDITION_WORKERS=0,
+                   IMAGE_RENDITION_WIDTHS=(16,))
+class RenditionsInvalidationTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+
+    def test_generate_renditions_command_invalidates_fragments(self):
+        output = BytesIO()
+        Image.new('RGB', (32, 32), 'red').save(output, 'PNG')
+        recipe = Recipe(author=create_user(0), name='Рецепт',
+                        text='Описание', cooking_time=10)
+        recipe.image.save('image.png', ContentFile(output.getvalue()))
+        Recipe.objects.filter(pk=recipe.pk).update(image_renditions='')
+        key = RECIPE_VERSION_KEY.format(recipe.pk)
+        version = get_cache_version(key)
+        response_version = get_cache_version()
+        call_command('generate_renditions', stdout=StringIO())
+        recipe.refresh_from_db()
+        self.assertTrue(recipe.get_renditions())
+        self.assertGreater(get_cache_version(key), version)
+        self.assertGreater(get_cache_version(), response_version)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class IngredientImportInvalidationTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'ingredients.csv')
+
+    def import_ingredients(self, *rows):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(','.join(row) for row in rows))
+        call_command('import_i', path=self.path, stdout=StringIO())
+
+    def test_import_invalidates_caches(self):
+        self.import_ingredients(('Salt', 'g'))
+        keys = (INGREDIENTS_VERSION_KEY, FRAGMENTS_VERSION_KEY)
+        versions = [get_cache_version(key) for key in keys]
+        response_version = get_cache_version()
+        self.import_ingredients(('salt', 'G'), ('Pepper', 'g'))
+        for key, version in zip(keys, versions):
+            self.assertGreater(get_cache_version(key), version)
+        self.assertGreater(get_cache_version(), response_version)
+
+
+class IngredientImportTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'ingredients.csv')
+
+    def import_ingredients(self, *rows, batch_size=2):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(','.join(row) for row in rows))
+        call_command('import_i', path=self.path, batch_size=batch_size,
+                     stdout=StringIO())
+        return sorted(Ingredient.objects.values_list(
+            'name', 'measurement_unit'
+        ))
+
+    def test_cyrillic_names_match_case_insensitively(self):
+        self.import_ingredients(('Соль', 'г'), ('Ёж', 'шт'))
+        self.assertEqual(
+            self.import_ingredients(('СОЛЬ', 'Г'), ('ёж', 'шт')),
+            [('СОЛЬ', 'Г'), ('ёж', 'шт')]
+        )
+
+    def test_duplicates_across_batches_are_skipped(self):
+        self.assertEqual(
+            self.import_ingredients(('Соль', 'г'), ('Перец', 'г'),
+                                    ('соль', 'г'), ('Соль ', ' г')),
+            [('Перец', 'г'), ('Соль', 'г')]
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class IngredientIndexTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        index = mock.patch.object(ingredient_index, '_index', None)
+        index.start()
+        self.addCleanup(index.stop)
+        # LIKE в SQLite не различает регистр только у латиницы, поэтому
+        # кириллические названия начинаются с заглавной, как в базе.
+        for name in ('Сахар', 'Сахарная пудра', 'Сало', 'Соль', 'Salt',
+                     'salsa', 'Basil'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def search(self, name, index):
+        # Кэш ответов отключён, иначе оба пути вернут один ответ.
+        with override_settings(INGREDIENT_INDEX=index, API_CACHE_TIMEOUT=0):
+            response = APIClient().get('/api/ingredients/', {'name': name})
+        self.assertEqual(response.status_code, 200)
+        return [ingredient['id'] for ingredient in response.data]
+
+    def assertSamePrefixMatches(self, *queries):
+        for query in queries:
+            with self.subTest(query=query):
+                expected = self.search(query, index=False)
+                found = self.search(query, index=True)
+                self.assertTrue(expected)
+                # После совпадений по префиксу индекс добавляет совпадения
+                # по подстроке.
+                self.assertCountEqual(found[:len(expected)], expected)
+
+    def test_case_insensitive_prefix(self):
+        self.assertSamePrefixMatches('sal', 'SAL', 'Sal', 'bAs')
+
+    def test_cyrillic_prefix(self):
+        self.assertSamePrefixMatches('Сах', 'Са', 'Сахарная', 'С')
+        if connection.vendor == 'postgresql':
+            self.assertSamePrefixMatches('сах', 'СОЛ')
+
+    def test_matches_after_import(self):
+        self.assertSamePrefixMatches('Сал')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'ingredients.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('Салака,г\nSalmon,г\n')
+        call_command('import_i', path=path, stdout=StringIO())
+        self.assertSamePrefixMatches('Сал', 'sal')
+        self.assertIn(
+            Ingredient.objects.get(name='Салака').id,
+            self.search('Сал', index=True)
+        )
+
+
+class ContentAddressedStorageTest(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.storage = ContentAddressedStorage(location=media.name)
+
+    def test_reused_file_is_touched(self):
+        name = self.storage.save('image.png', ContentFile(b'image'))
+        path = self.storage.path(name)
+        os.utime(path, (0, 0))
+        self.assertEqual(
+            self.storage.save('copy.png', ContentFile(b'image')), name
+        )
+        self.assertGreater(os.path.getmtime(path), 0)
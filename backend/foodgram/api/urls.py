@@ -23,5 +23,7 @@ urlpatterns = [
     path('users/<int:author_id>/subscribe/', views.subscribe),
     path('recipes/<int:recipe_id>/shopping_cart/', views.shopping_cart),
     path('recipes/download_shopping_cart/', views.download_shopping_cart),
+    path('recipes/match/', views.match_recipes_by_ingredients),
+    path('metrics/', views.metrics),
     path('', include(router.urls)),
 ]
@@ -1,48 +1,63 @@
+from django.conf import settings as djset
 from django.contrib.auth import update_session_auth_hash
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.db import IntegrityError, transaction
+from django.db.models import BooleanField, Sum, Value
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser import utils
 from djoser.compat import get_user_email
 from djoser.conf import settings
-from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
+from recipes.models import (Favorite, Ingredient, Recipe, ShoppingCart,
+                            ShoppingListItem, Tag)
 from rest_framework import mixins, serializers, status, viewsets
-from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.decorators import (action, api_view, permission_classes,
+                                       renderer_classes)
 from rest_framework.response import Response
 from users.models import Follow, User
 
+from .cache import CachedResponseMixin
 from .filters import IngredientFilter, RecipeFilter
-from .pagination import UserPagination
-from .permissions import (IsAuthenticated, IsAuthenticatedReadOnly,
+from .ingredient_index import get_ingredient_index
+from .metrics import registry
+from .pagination import (KeysetPagination, SubscriptionPagination,
+                         UserPagination)
+from .permissions import (IsAdmin, IsAuthenticated, IsAuthenticatedReadOnly,
                           IsOwnerAdminOrReadOnly)
+from .recipe_index import match_recipes
+from .renderers import SHOPPING_LIST_RENDERERS
 from .serializers import (CreateRecipeSerializer, FavoriteRecipeSerializer,
                           FavoriteSerializer, IngredientSerializer,
-                          RecipeSerializer, ShoppingCartSerializer,
-                          SubscriptionSerializer, TagSerializer,
-                          UserSerializer)
+                          MatchedRecipeSerializer, RecipeSerializer,
+                          ShoppingCartSerializer, SubscriptionSerializer,
+                          TagSerializer, UserSerializer)
 
 
 @api_view(['POST', 'DELETE'])
 @permission_classes([IsAuthenticated])
 def favorite(request, recipe_id):
     if request.method == 'DELETE':
-        favorite = get_object_or_404(
-            Favorite,
-            user=request.user,
-            recipe__id=recipe_id
-        )
-        favorite.delete()
+        with transaction.atomic():
+            deleted, _ = Favorite.objects.filter(
+                user=request.user,
+                recipe__id=recipe_id
+            ).delete()
+            if not deleted:
+                raise Http404
         return Response(status=status.HTTP_204_NO_CONTENT)
     if request.method == 'POST':
         serializer = FavoriteSerializer(data=request.data)
         if serializer.is_valid():
-            recipe = get_object_or_404(Recipe, pk=recipe_id)
-            if Favorite.objects.filter(user=request.user, recipe=recipe):
+            recipe = get_object_or_404(
+                Recipe.objects.defer('search_vector'), pk=recipe_id
+            )
+            try:
+                with transaction.atomic():
+                    serializer.save(user=request.user,
+                                    recipe_id=recipe_id)
+            except IntegrityError:
                 raise serializers.ValidationError(
                     {'errors': 'Нельзя больше одного избранного!'})
-            serializer.save(user=request.user,
-                            recipe_id=recipe_id)
             print_serializer = FavoriteRecipeSerializer(recipe)
             return Response(
                 print_serializer.data,
@@ -59,25 +74,27 @@ def favorite(request, recipe_id):
 @permission_classes([IsAuthenticated])
 def shopping_cart(request, recipe_id):
     if request.method == 'DELETE':
-        shopping_cart = get_object_or_404(
-            ShoppingCart,
-            user=request.user,
-            recipe__id=recipe_id
-        )
-        shopping_cart.delete()
+        with transaction.atomic():
+            deleted, _ = ShoppingCart.objects.filter(
+                user=request.user,
+                recipe__id=recipe_id
+            ).delete()
+            if not deleted:
+                raise Http404
         return Response(status=status.HTTP_204_NO_CONTENT)
     if request.method == 'POST':
         serializer = ShoppingCartSerializer(data=request.data)
         if serializer.is_valid():
-            recipe = get_object_or_404(Recipe, pk=recipe_id)
-            if ShoppingCart.objects.filter(
-                user=request.user,
-                recipe=recipe
-            ):
+            recipe = get_object_or_404(
+                Recipe.objects.defer('search_vector'), pk=recipe_id
+            )
+            try:
+                with transaction.atomic():
+                    serializer.save(user=request.user,
+                                    recipe_id=recipe_id)
+            except IntegrityError:
                 raise serializers.ValidationError(
                     {'errors': 'Рецепт уже в списке покупок!'})
-            serializer.save(user=request.user,
-                            recipe_id=recipe_id)
             print_serializer = FavoriteRecipeSerializer(recipe)
             return Response(
                 print_serializer.data,
@@ -94,12 +111,13 @@ def shopping_cart(request, recipe_id):
 @permission_classes([IsAuthenticated])
 def subscribe(request, author_id):
     if request.method == 'DELETE':
-        subscription = get_object_or_404(
-            Follow,
-            user=request.user,
-            author__id=author_id
-        )
-        subscription.delete()
+        with transaction.atomic():
+            deleted, _ = Follow.objects.filter(
+                user=request.user,
+                author__id=author_id
+            ).delete()
+            if not deleted:
+                raise Http404
         return Response(status=status.HTTP_204_NO_CONTENT)
     if request.method == 'POST':
         serializer = SubscriptionSerializer(
@@ -108,11 +126,16 @@ def subscribe(request, author_id):
         )
         if serializer.is_valid():
             author = get_object_or_404(User, id=author_id)
-            if Follow.objects.filter(user=request.user, author_id=author.id):
+            if author.id == request.user.id:
+                raise serializers.ValidationError(
+                    {'errors': 'Нельзя подписываться на себя!'})
+            try:
+                with transaction.atomic():
+                    serializer.save(user=request.user,
+                                    author_id=author.id)
+            except IntegrityError:
                 raise serializers.ValidationError(
                     {'errors': 'Нельзя добавить больше одной подписки!'})
-            serializer.save(user=request.user,
-                            author_id=author.id)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -120,41 +143,79 @@ def subscribe(request, author_id):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@renderer_classes(SHOPPING_LIST_RENDERERS)
 def download_shopping_cart(request):
-    user = request.user
-    shopping_cart_list = list(user.buyer.all().values())
-    recipe_id_list = []
-    for element in shopping_cart_list:
-        recipe_id_list.append(element['recipe_id'])
-    ingredients_queryset = Recipe.ingredients.through.objects.filter(
-        recipe_id__in=recipe_id_list
+    ingredients = ShoppingListItem.objects.filter(
+        user=request.user
     ).values(
         'ingredient__name', 'ingredient__measurement_unit'
     ).order_by(
         'ingredient__name'
     ).annotate(total_amount=Sum('amount'))
-    shop_list = []
-    for ingredient in ingredients_queryset:
-        ingredient_name = ingredient.get('ingredient__name').capitalize()
-        ingredient_unit = ingredient.get('ingredient__measurement_unit')
-        ingredient_amount = ingredient.get('total_amount')
-        shop_list.append(
-            f'{ingredient_name} ({ingredient_unit}) - {ingredient_amount}'
-        )
-    file = open('media/shop_list.txt', 'w')
-    file.write('\n'.join(shop_list))
-    file.close()
-    file = open('media/shop_list.txt', 'r')
-    response = HttpResponse(
-        file.read(),
-        content_type='text/plain; charset=UTF-8'
+    renderer = request.accepted_renderer
+    response = StreamingHttpResponse(
+        renderer.stream(ingredients.iterator()),
+        content_type=f'{renderer.media_type}; charset={renderer.charset}'
     )
     response['Content-Disposition'] = (
-        'attachment; filename="shop_list.txt"'
+        f'attachment; filename="shop_list.{renderer.format}"'
     )
     return response
 
 
+@api_view(['GET'])
+@permission_classes([IsAdmin])
+def metrics(request):
+    return HttpResponse(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+def parse_ids(values):
+    ids = set()
+    for value in values:
+        for item in value.split(','):
+            if item.strip():
+                ids.add(int(item))
+    return ids
+
+
+@api_view(['GET'])
+def match_recipes_by_ingredients(request):
+    """Рецепты, которые можно приготовить из указанных ингредиентов."""
+    try:
+        ingredient_ids = parse_ids(
+            request.query_params.getlist('ingredients')
+        )
+        max_missing = request.query_params.get('max_missing')
+        max_missing = None if max_missing is None else int(max_missing)
+    except ValueError:
+        raise serializers.ValidationError(
+            {'errors': 'Ингредиенты и max_missing задаются целыми числами'})
+    if not ingredient_ids:
+        raise serializers.ValidationError(
+            {'errors': 'Нужно выбрать ингредиенты!'})
+    paginator = UserPagination()
+    page = paginator.paginate_queryset(
+        match_recipes(ingredient_ids, max_missing), request
+    )
+    recipes = Recipe.objects.defer('search_vector').in_bulk(
+        [recipe_id for recipe_id, _, _ in page]
+    )
+    matched = []
+    for recipe_id, coverage, missing in page:
+        if recipe_id in recipes:
+            recipe = recipes[recipe_id]
+            recipe.coverage = coverage
+            recipe.missing_count = missing
+            matched.append(recipe)
+    serializer = MatchedRecipeSerializer(
+        matched, many=True, context={'request': request}
+    )
+    return paginator.get_paginated_response(serializer.data)
+
+
 class UserViewSet(mixins.CreateModelMixin,
                   mixins.ListModelMixin,
                   mixins.RetrieveModelMixin,
@@ -165,7 +226,7 @@ class UserViewSet(mixins.CreateModelMixin,
 
     def retrieve(self, request, pk=None):
         pk_user = get_object_or_404(
-            User,
+            self.get_queryset(),
             pk=pk
         )
         serializer = self.get_serializer(pk_user)
@@ -193,7 +254,7 @@ class UserViewSet(mixins.CreateModelMixin,
     def me(self, request):
         request_user = request.user
         me_user = get_object_or_404(
-            User,
+            self.get_queryset(),
             id=request_user.id
         )
         serializer = self.get_serializer(me_user)
@@ -205,7 +266,7 @@ class UserViewSet(mixins.CreateModelMixin,
         serializer.is_valid(raise_exception=True)
 
         self.request.user.set_password(serializer.data["new_password"])
-        self.request.user.save()
+        self.request.user.save(update_fields=['password'])
 
         if settings.PASSWORD_CHANGED_EMAIL_CONFIRMATION:
             context = {"user": self.request.user}
@@ -222,31 +283,19 @@ class UserViewSet(mixins.CreateModelMixin,
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
-    pagination_class = UserPagination
+class RecipeViewSet(CachedResponseMixin, viewsets.ModelViewSet):
+    cache_authenticated = False
+    pagination_class = KeysetPagination
     permission_classes = [IsOwnerAdminOrReadOnly]
     filter_backends = [DjangoFilterBackend]
     filterset_class = RecipeFilter
 
-    def fav_shop_filter(self, queryset):
-        recipes_id = []
-        for i in range(queryset.count()):
-            recipes_id.append(queryset.values()[i]['recipe_id'])
-        return Recipe.objects.filter(
-            id__in=recipes_id
-        ).order_by('-created')
-
     def get_queryset(self):
-        is_favorited = self.request.query_params.get('is_favorited')
-        is_in_shopping_cart = self.request.query_params.get(
-            'is_in_shopping_cart')
-        if is_favorited is not None and bool(int(is_favorited)):
-            favorited = Favorite.objects.filter(user=self.request.user)
-            return self.fav_shop_filter(favorited)
-        if is_in_shopping_cart is not None and bool(int(is_in_shopping_cart)):
-            shopping_cart = ShoppingCart.objects.filter(user=self.request.user)
-            return self.fav_shop_filter(shopping_cart)
-        return Recipe.objects.all().order_by('-created')
+        # Связи для ответа загружает RecipeSerializer, и только для
+        # рецептов, которых нет в кэше фрагментов.
+        return Recipe.objects.defer('search_vector').order_by(
+            '-created', '-id'
+        )
 
     def perform_create(self, serializer):
         return serializer.save(author=self.request.user)
@@ -256,7 +305,8 @@ class RecipeViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         instance = self.perform_create(serializer)
         instance_serializer = RecipeSerializer(
-            instance, context={'request': request}
+            self.get_queryset().get(pk=instance.pk),
+            context={'request': request}
         )
         return Response(instance_serializer.data)
 
@@ -268,7 +318,8 @@ class RecipeViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         instance = serializer.save()
         instance_serializer = RecipeSerializer(
-            instance, context={'request': request}
+            self.get_queryset().get(pk=instance.pk),
+            context={'request': request}
         )
         return Response(instance_serializer.data)
 
@@ -278,7 +329,8 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return RecipeSerializer
 
 
-class TagViewSet(mixins.ListModelMixin,
+class TagViewSet(CachedResponseMixin,
+                 mixins.ListModelMixin,
                  mixins.RetrieveModelMixin,
                  viewsets.GenericViewSet):
     queryset = Tag.objects.all()
@@ -286,7 +338,8 @@ class TagViewSet(mixins.ListModelMixin,
     permission_classes = [IsOwnerAdminOrReadOnly]
 
 
-class IngredientViewSet(mixins.ListModelMixin,
+class IngredientViewSet(CachedResponseMixin,
+                        mixins.ListModelMixin,
                         mixins.RetrieveModelMixin,
                         viewsets.GenericViewSet):
     queryset = Ingredient.objects.all()
@@ -295,12 +348,29 @@ class IngredientViewSet(mixins.ListModelMixin,
     filter_backends = (DjangoFilterBackend,)
     filterset_class = IngredientFilter
 
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if name is None or not djset.INGREDIENT_INDEX:
+            return super().list(request, *args, **kwargs)
+        return Response(get_ingredient_index().search(name))
+
 
 class SubscriptionViewSet(mixins.ListModelMixin,
                           viewsets.GenericViewSet):
     serializer_class = SubscriptionSerializer
-    pagination_class = UserPagination
+    pagination_class = SubscriptionPagination
     permission_classes = [IsAuthenticatedReadOnly]
 
     def get_queryset(self):
-        return Follow.objects.filter(user=self.request.user)
+        return Follow.objects.filter(
+            user=self.request.user
+        ).select_related('author').annotate(
+            is_subscribed=Value(True, output_field=BooleanField())
+        )
+
+    def paginate_queryset(self, queryset):
+        recipes_limit = SubscriptionSerializer.get_recipes_limit(self.request)
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            SubscriptionSerializer.prefetch_recipes(page, recipes_limit)
+        return page
@@ -0,0 +1,53 @@
+"""
+ASGI config for foodgram project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+Django 2.2 has no ASGI handler, so the WSGI application is served through
+asgiref: the event loop reads request bodies from slow clients, and only
+complete requests are handed to a bounded pool of threads.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
+
+
+class ThreadPoolApplication:
+    def __init__(self, application, max_threads):
+        self.application = application
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_threads, thread_name_prefix='asgi'
+        )
+        self.loop = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            # sync_to_async выполняет представления в пуле по умолчанию.
+            loop.set_default_executor(self.executor)
+            self.loop = loop
+        return await self.application(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = ThreadPoolApplication(
+    WsgiToAsgi(get_wsgi_application()), settings.ASGI_THREADS
+)
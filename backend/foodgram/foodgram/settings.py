@@ -53,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',
+    'api.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,21 +84,90 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'foodgram.wsgi.application'
 
+# Потоки, в которых foodgram.asgi выполняет запросы в одном воркере.
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 16))
+
 
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
 DATABASES = {
     'default': {
+        # В docker-compose задан api.backends.postgresql - PostgreSQL
+        # с ленивой проверкой постоянных соединений.
         'ENGINE': os.getenv('DB_ENGINE', 'django.db.backends.postgresql'),
         'NAME': os.getenv('DB_NAME'),
         'USER': os.getenv('POSTGRES_USER'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
-        'PORT': os.getenv('DB_PORT')
+        'PORT': os.getenv('DB_PORT'),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        # При пулинге транзакций серверные курсоры работать не могут.
+        'DISABLE_SERVER_SIDE_CURSORS': (
+            os.getenv('DB_POOLER', '') == 'transaction'
+        ),
+    }
+}
+
+# Реплики для чтения через запятую: host[:port], для SQLite - пути к файлам.
+DB_REPLICAS = []
+for address in filter(None, os.getenv('DB_REPLICAS', '').split(',')):
+    replica = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    if replica['ENGINE'] == 'django.db.backends.sqlite3':
+        replica['NAME'] = address.strip()
+    else:
+        host, _, port = address.strip().partition(':')
+        replica.update(HOST=host, PORT=port or replica['PORT'])
+    DATABASES[f'replica_{len(DB_REPLICAS)}'] = replica
+    DB_REPLICAS.append(f'replica_{len(DB_REPLICAS)}')
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+DB_REPLICA_PIN_SECONDS = int(os.getenv('DB_REPLICA_PIN_SECONDS', 15))
+
+# '' - прямое подключение к PostgreSQL, 'transaction' - через PgBouncer
+# в режиме pool_mode = transaction.
+DB_POOLER = os.getenv('DB_POOLER', '')
+DB_CONN_HEALTH_CHECKS = os.getenv('DB_CONN_HEALTH_CHECKS', 'True') == 'True'
+DB_READ_STATEMENT_TIMEOUT_MS = (
+    int(os.getenv('DB_READ_STATEMENT_TIMEOUT_MS'))
+    if os.getenv('DB_READ_STATEMENT_TIMEOUT_MS') else None
+)
+DB_WRITE_STATEMENT_TIMEOUT_MS = (
+    int(os.getenv('DB_WRITE_STATEMENT_TIMEOUT_MS'))
+    if os.getenv('DB_WRITE_STATEMENT_TIMEOUT_MS') else None
+)
+
+
+# Версии кэша должны быть общими для всех воркеров и команд управления,
+# поэтому в docker-compose кэш хранится в Redis. LocMemCache остаётся
+# для тестов и локального запуска без REDIS_URL.
+REDIS_URL = os.getenv('REDIS_URL')
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django_redis.cache.RedisCache' if REDIS_URL
+            else 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', REDIS_URL or ''),
     }
 }
 
+API_CACHE_TIMEOUT = int(os.getenv('API_CACHE_TIMEOUT', 60 * 15))
+RELATIONS_CACHE_TIMEOUT = int(os.getenv('RELATIONS_CACHE_TIMEOUT', 60))
+RECIPE_FRAGMENT_TIMEOUT = int(
+    os.getenv('RECIPE_FRAGMENT_TIMEOUT', 60 * 60 * 24)
+)
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+# Запросы, превысившие бюджет, пишутся в лог вместе с повторяющимся SQL.
+METRICS_QUERY_BUDGET = (int(os.getenv('METRICS_QUERY_BUDGET'))
+                        if os.getenv('METRICS_QUERY_BUDGET') else None)
+METRICS_TIME_BUDGET_MS = (int(os.getenv('METRICS_TIME_BUDGET_MS'))
+                          if os.getenv('METRICS_TIME_BUDGET_MS') else None)
+
+INGREDIENT_INDEX = os.getenv('INGREDIENT_INDEX', 'True') == 'True'
+
 
 AUTH_USER_MODEL = 'users.User'
 
@@ -143,6 +214,12 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'dj_static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv('IMAGE_UPLOAD_MAX_BYTES', 10 * 2 ** 20))
+IMAGE_UPLOAD_MAX_PIXELS = int(os.getenv('IMAGE_UPLOAD_MAX_PIXELS', 40_000_000))
+
+IMAGE_RENDITION_WIDTHS = (320, 640, 1280)
+IMAGE_RENDITION_WORKERS = int(os.getenv('IMAGE_RENDITION_WORKERS', 2))
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
@@ -167,3 +244,7 @@ EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'sent_emails')
 ADMIN_EMAIL = 'admin@foodgram.ru'
 
 PAGE_LIMIT = 6
+
+RECIPES_LIMIT_MAX = 50
+
+TRENDING_HALF_LIFE_HOURS = int(os.getenv('TRENDING_HALF_LIFE_HOURS', 48))
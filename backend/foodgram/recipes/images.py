@@ -0,0 +1,101 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections
+from PIL import Image, ImageOps
+
+from .signals import renditions_ready
+from .storage import content_storage
+
+logger = logging.getLogger(__name__)
+
+RENDITION_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_RENDITION_WORKERS,
+            thread_name_prefix='renditions'
+        )
+    return _executor
+
+
+def save_rendition(content, extension):
+    return content_storage.save(f'rendition.{extension}', ContentFile(content))
+
+
+def make_renditions(image_file):
+    """Уменьшенные копии картинки без метаданных: {формат: {ширина: имя}}."""
+    with Image.open(image_file) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'A' in original.getbands()
+                                        else 'RGB')
+        widths = [
+            width for width in settings.IMAGE_RENDITION_WIDTHS
+            if width < original.width
+        ] or [original.width]
+        renditions = {extension: {} for extension in RENDITION_FORMATS}
+        for width in widths:
+            height = max(1, round(original.height * width / original.width))
+            resized = original.resize((width, height), Image.LANCZOS)
+            for extension, (image_format, options) in (
+                RENDITION_FORMATS.items()
+            ):
+                image = resized
+                if image_format == 'JPEG' and image.mode != 'RGB':
+                    image = image.convert('RGB')
+                output = BytesIO()
+                image.save(output, image_format, **options)
+                renditions[extension][str(width)] = save_rendition(
+                    output.getvalue(), extension
+                )
+    return renditions
+
+
+def generate_renditions(recipe_id):
+    from .models import Recipe
+
+    try:
+        recipe = Recipe.objects.filter(pk=recipe_id).only('image').first()
+        if recipe is None or not recipe.image:
+            return
+        with recipe.image.open('rb') as image_file:
+            renditions = make_renditions(image_file)
+        # Если картинку успели заменить, результат уже не нужен.
+        updated = Recipe.objects.filter(
+            pk=recipe_id, image=recipe.image.name
+        ).update(image_renditions=json.dumps(
+            {'source': recipe.image.name, 'renditions': renditions}
+        ))
+        if updated:
+            renditions_ready.send(sender=Recipe, recipe_id=recipe_id)
+    except Exception:
+        logger.exception('Не удалось подготовить копии картинки рецепта %s',
+                         recipe_id)
+
+
+def generate_renditions_in_worker(recipe_id):
+    try:
+        generate_renditions(recipe_id)
+    finally:
+        connections.close_all()
+
+
+def schedule_renditions(recipe_id):
+    """Готовит копии в фоновом потоке, по готовности - renditions_ready."""
+    if settings.IMAGE_RENDITION_WORKERS:
+        get_executor().submit(generate_renditions_in_worker, recipe_id)
+    else:
+        generate_renditions(recipe_id)
@@ -0,0 +1,65 @@
+import json
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from recipes.models import Recipe
+from recipes.storage import CONTENT_DIRECTORY, content_storage
+
+
+def walk(storage, path):
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield f'{path}/{name}'
+    for directory in directories:
+        yield from walk(storage, f'{path}/{directory}')
+
+
+class Command(BaseCommand):
+    help = 'Delete recipe images and renditions no recipe refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only list unused files'
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=60 * 60,
+            help='Keep files younger than N seconds'
+        )
+
+    def get_referenced(self):
+        referenced = set()
+        for image, renditions in Recipe.objects.values_list(
+            'image', 'image_renditions'
+        ).iterator():
+            referenced.add(image)
+            if renditions:
+                for names in json.loads(renditions)['renditions'].values():
+                    referenced.update(names.values())
+        return referenced
+
+    def handle(self, *args, **kwargs):
+        if not content_storage.exists(CONTENT_DIRECTORY):
+            return
+        # Свежие файлы не трогаем: транзакция, которая на них ссылается,
+        # может быть ещё не завершена.
+        threshold = timezone.now() - timedelta(seconds=kwargs['min_age'])
+        referenced = self.get_referenced()
+        deleted = 0
+        for name in walk(content_storage, CONTENT_DIRECTORY):
+            if (name in referenced
+                    or content_storage.get_modified_time(name) > threshold):
+                continue
+            self.stdout.write(name)
+            if not kwargs['dry_run']:
+                content_storage.delete(name)
+            deleted += 1
+        action = 'Найдено' if kwargs['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} неиспользуемых файлов: {deleted}'
+        ))
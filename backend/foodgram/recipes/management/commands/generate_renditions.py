@@ -0,0 +1,26 @@
+from django.core.management import BaseCommand
+
+from recipes.images import generate_renditions
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Generate resized copies of recipe images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Regenerate copies for all recipes'
+        )
+
+    def handle(self, *args, **kwargs):
+        generated = 0
+        recipes = Recipe.objects.exclude(image='').exclude(image__isnull=True)
+        for recipe in recipes.only('image', 'image_renditions').iterator():
+            if kwargs['force'] or not recipe.get_renditions():
+                generate_renditions(recipe.pk)
+                generated += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Подготовлены копии картинок рецептов: {generated}'
+        ))
@@ -1,22 +1,159 @@
+import codecs
 import csv
+import json
+import os
+from itertools import islice
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
 
 from recipes.models import Ingredient
+from recipes.signals import ingredients_imported
+
+JSON_SEPARATORS = ' \t\r\n,['
+
+
+def detect_encoding(path):
+    with open(path, mode='rb') as f:
+        sample = f.read(2 ** 16)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample)
+    except UnicodeDecodeError:
+        return 'cp1251'
+    return 'utf-8'
+
+
+def read_csv(f):
+    for row in csv.reader(f):
+        yield row[0] if row else '', row[1] if len(row) > 1 else ''
+
+
+def read_json(f, chunk_size=2 ** 16):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        while position < len(buffer) and buffer[position] in JSON_SEPARATORS:
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                if position < len(buffer):
+                    raise CommandError('Некорректный JSON')
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item.get('name', ''), item.get('measurement_unit', '')
+
+
+def normalize(value):
+    return ' '.join(str(value or '').split())
+
+
+def ingredient_key(name, measurement_unit):
+    return name.casefold(), measurement_unit.casefold()
 
 
 class Command(BaseCommand):
-    help = 'Load dara from csv file into the database'
+    help = 'Load ingredients from csv or json file into the database'
 
     def add_arguments(self, parser):
-        parser.add_argument('--path', type=str)
+        parser.add_argument('--path', type=str, required=True)
+        parser.add_argument('--format', choices=('csv', 'json'))
+        parser.add_argument('--encoding', type=str)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def load_existing(self, chunk_size):
+        # Названия сравниваются по casefold() в Python: LOWER в SQLite
+        # не меняет регистр кириллицы. Таблица читается один раз частями
+        # по pk, а не отдельным запросом на каждую пачку файла.
+        existing = {}
+        last_pk = 0
+        while True:
+            chunk = list(Ingredient.objects.filter(pk__gt=last_pk).order_by(
+                'pk'
+            ).values_list('id', 'name', 'measurement_unit')[:chunk_size])
+            if not chunk:
+                return existing
+            for ingredient_id, name, measurement_unit in chunk:
+                existing.setdefault(
+                    ingredient_key(normalize(name),
+                                   normalize(measurement_unit)),
+                    (ingredient_id, name, measurement_unit)
+                )
+            last_pk = chunk[-1][0]
+
+    def import_batch(self, batch):
+        changed, created = [], []
+        for name, measurement_unit in batch:
+            name = normalize(name)
+            measurement_unit = normalize(measurement_unit)
+            key = ingredient_key(name, measurement_unit)
+            # Ключ, уже встреченный в файле, отмечен как None.
+            if not name or not measurement_unit or (
+                key in self.existing and self.existing[key] is None
+            ):
+                self.skipped += 1
+                continue
+            ingredient = self.existing.get(key)
+            self.existing[key] = None
+            if ingredient is None:
+                created.append(Ingredient(
+                    name=name, measurement_unit=measurement_unit
+                ))
+            elif (name, measurement_unit) == ingredient[1:]:
+                self.skipped += 1
+            else:
+                changed.append(Ingredient(
+                    id=ingredient[0],
+                    name=name,
+                    measurement_unit=measurement_unit
+                ))
+        Ingredient.objects.bulk_update(changed, ['name', 'measurement_unit'])
+        self.updated_ids.extend(ingredient.id for ingredient in changed)
+        Ingredient.objects.bulk_create(created)
+        self.updated += len(changed)
+        self.inserted += len(created)
+
+    def send_imported(self):
+        ingredients_imported.send(
+            sender=Ingredient,
+            updated_ids=self.updated_ids,
+            inserted=self.inserted
+        )
 
     def handle(self, *args, **kwargs):
         path = kwargs['path']
-        with open(path, mode='rt', encoding='cp1251') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                Ingredient.objects.create(
-                    name=row[0],
-                    measurement_unit=row[1],
-                )
+        if not os.path.isfile(path):
+            raise CommandError(f'Файл {path} не найден')
+        file_format = kwargs['format'] or os.path.splitext(path)[1][1:]
+        readers = {'csv': read_csv, 'json': read_json}
+        if file_format not in readers:
+            raise CommandError('Поддерживаются только форматы csv и json')
+        encoding = kwargs['encoding'] or detect_encoding(path)
+        self.inserted = self.updated = self.skipped = 0
+        self.updated_ids = []
+        with open(path, mode='rt', encoding=encoding, newline='') as f:
+            rows = readers[file_format](f)
+            with transaction.atomic():
+                self.existing = self.load_existing(kwargs['batch_size'])
+                while True:
+                    batch = list(islice(rows, kwargs['batch_size']))
+                    if not batch:
+                        break
+                    self.import_batch(batch)
+                if self.inserted or self.updated_ids:
+                    transaction.on_commit(self.send_imported)
+        self.stdout.write(self.style.SUCCESS(
+            f'Добавлено: {self.inserted}, обновлено: {self.updated}, '
+            f'пропущено: {self.skipped}'
+        ))
@@ -0,0 +1,56 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+
+from recipes.models import ShoppingListItem
+
+
+class Command(BaseCommand):
+    help = 'Rebuild shopping lists from carts and verify them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only compare stored shopping lists with carts'
+        )
+
+    def get_drift(self):
+        expected = {
+            (total['recipe__shoppingrecipe__user'],
+             total['ingredient']): total['total_amount']
+            for total in ShoppingListItem.objects.compute()
+        }
+        stored = {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount
+            in ShoppingListItem.objects.values_list(
+                'user_id', 'ingredient_id', 'amount'
+            )
+        }
+        return {
+            key: (stored.get(key), expected.get(key))
+            for key in {*expected, *stored}
+            if stored.get(key) != expected.get(key)
+        }
+
+    def handle(self, *args, **kwargs):
+        if not kwargs['check']:
+            with transaction.atomic():
+                ShoppingListItem.objects.all().delete()
+                ShoppingListItem.objects.bulk_create(
+                    ShoppingListItem(
+                        user_id=total['recipe__shoppingrecipe__user'],
+                        ingredient_id=total['ingredient'],
+                        amount=total['total_amount']
+                    )
+                    for total in ShoppingListItem.objects.compute()
+                )
+        drift = self.get_drift()
+        for (user_id, ingredient_id), (stored, expected) in drift.items():
+            self.stderr.write(
+                f'user={user_id} ingredient={ingredient_id}: '
+                f'stored={stored} expected={expected}'
+            )
+        if drift:
+            raise CommandError(f'Расхождений в списках покупок: {len(drift)}')
+        self.stdout.write(self.style.SUCCESS('Списки покупок согласованы'))
@@ -0,0 +1,59 @@
+from django.core.management import BaseCommand, CommandError
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Recipe, ShoppingCart
+from users.models import Follow, User
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'author'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Find and repair drift of denormalized counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report drift without repairing it'
+        )
+
+    def get_drift(self, model, counter, related_model, related_field):
+        actual = Coalesce(Subquery(
+            related_model.objects.filter(
+                **{related_field: OuterRef('pk')}
+            ).order_by().values(related_field).annotate(
+                total=Count('pk')
+            ).values('total'),
+            output_field=IntegerField()
+        ), 0)
+        return list(model.objects.annotate(
+            actual=actual
+        ).exclude(**{counter: F('actual')}).order_by())
+
+    def handle(self, *args, **kwargs):
+        total = 0
+        for model, counter, related_model, related_field in COUNTERS:
+            drift = self.get_drift(
+                model, counter, related_model, related_field
+            )
+            for obj in drift:
+                self.stderr.write(
+                    f'{model.__name__}(pk={obj.pk}).{counter}: '
+                    f'stored={getattr(obj, counter)} actual={obj.actual}'
+                )
+                setattr(obj, counter, obj.actual)
+            if not kwargs['check']:
+                model.objects.bulk_update(drift, [counter])
+            total += len(drift)
+        if total and kwargs['check']:
+            raise CommandError(f'Расхождений в счётчиках: {total}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Исправлено счётчиков: {total}' if total
+            else 'Счётчики согласованы'
+        ))
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.6 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_shoppinglistitem'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ingredient',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100, null=True, verbose_name='Название'),
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX recipes_ingredient_name_lower '
+            'ON recipes_ingredient (lower(name));',
+            'DROP INDEX recipes_ingredient_name_lower;'
+        ),
+    ]
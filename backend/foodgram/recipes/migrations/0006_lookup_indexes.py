@@ -0,0 +1,78 @@
+# Generated by Django 2.2.6 on 2026-10-18 19:10
+
+from django.db import migrations, models
+
+INGREDIENT_NAME_LIKE_INDEX = 'recipes_ingredient_name_upper_like'
+
+
+def create_ingredient_name_like_index(apps, schema_editor):
+    # istartswith на PostgreSQL сравнивает UPPER(name::text) через LIKE,
+    # такой индекс с text_pattern_ops работает при любой локали базы.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f'CREATE INDEX {INGREDIENT_NAME_LIKE_INDEX} ON recipes_ingredient '
+            '(UPPER(name::text) text_pattern_ops);'
+        )
+
+
+def drop_ingredient_name_like_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX {INGREDIENT_NAME_LIKE_INDEX};')
+
+
+def delete_shopping_cart_duplicates(apps, schema_editor):
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    IngredientAmount = apps.get_model('recipes', 'IngredientAmount')
+    ShoppingListItem = apps.get_model('recipes', 'ShoppingListItem')
+    duplicates = ShoppingCart.objects.values(
+        'user', 'recipe'
+    ).order_by().annotate(
+        first_id=models.Min('id'), total=models.Count('id')
+    ).filter(total__gt=1)
+    if not duplicates:
+        return
+    for duplicate in duplicates:
+        ShoppingCart.objects.filter(
+            user_id=duplicate['user'],
+            recipe_id=duplicate['recipe']
+        ).exclude(id=duplicate['first_id']).delete()
+    totals = IngredientAmount.objects.filter(
+        recipe__shoppingrecipe__isnull=False
+    ).values(
+        'recipe__shoppingrecipe__user', 'ingredient'
+    ).order_by().annotate(total_amount=models.Sum('amount'))
+    ShoppingListItem.objects.all().delete()
+    ShoppingListItem.objects.bulk_create(
+        ShoppingListItem(
+            user_id=total['recipe__shoppingrecipe__user'],
+            ingredient_id=total['ingredient'],
+            amount=total['total_amount']
+        )
+        for total in totals
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_ingredient_name_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-created', '-id'], name='recipe_created_idx'),
+        ),
+        migrations.RunPython(
+            create_ingredient_name_like_index,
+            drop_ingredient_name_like_index
+        ),
+        migrations.RunPython(
+            delete_shopping_cart_duplicates,
+            migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='shoppingcart',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_shopping_cart'),
+        ),
+    ]
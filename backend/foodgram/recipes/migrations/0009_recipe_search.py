@@ -0,0 +1,31 @@
+# Generated by Django 2.2.6 on 2026-10-18 19:16
+
+import django.contrib.postgres.search
+from django.db import migrations
+from recipes.search import (create_search_index, drop_search_index,
+                            update_search_index)
+
+
+def fill_search_index(apps, schema_editor):
+    create_search_index(schema_editor)
+    update_search_index(apps.get_model('recipes', 'Recipe'))
+
+
+def remove_search_index(apps, schema_editor):
+    drop_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_recipe_scores'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый индекс'),
+        ),
+        migrations.RunPython(fill_search_index, remove_search_index),
+    ]
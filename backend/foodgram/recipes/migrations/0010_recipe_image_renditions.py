@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-18 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_renditions',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='Уменьшенные копии картинки'),
+        ),
+    ]
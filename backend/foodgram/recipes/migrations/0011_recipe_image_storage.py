@@ -0,0 +1,19 @@
+# Generated by Django 2.2.6 on 2026-10-18 19:26
+
+from django.db import migrations, models
+import recipes.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_recipe_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(null=True, storage=recipes.storage.ContentAddressedStorage(), upload_to='', verbose_name='Картинка'),
+        ),
+    ]
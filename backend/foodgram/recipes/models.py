@@ -1,7 +1,13 @@
+import json
+
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Sum, Value, When
 from users.models import User
 
+from .storage import content_storage
+
 
 class Tag(models.Model):
     name = models.CharField(
@@ -28,7 +34,7 @@ class Tag(models.Model):
 class Ingredient(models.Model):
     name = models.CharField(
         max_length=100,
-        blank=False, null=True,
+        blank=False, null=True, db_index=True,
         verbose_name='Название')
     measurement_unit = models.CharField(
         max_length=15,
@@ -56,7 +62,8 @@ class Recipe(models.Model):
         verbose_name='Название')
     image = models.ImageField(
         blank=False, null=True,
-        verbose_name='Картинка'
+        verbose_name='Картинка',
+        storage=content_storage
     )
     text = models.TextField(
         blank=False, null=True,
@@ -85,9 +92,47 @@ class Recipe(models.Model):
         'Дата публикации',
         auto_now_add=True
     )
+    favorites_count = models.IntegerField(
+        'Добавлений в избранное',
+        default=0, editable=False, db_index=True
+    )
+    in_carts_count = models.IntegerField(
+        'Добавлений в списки покупок',
+        default=0, editable=False
+    )
+    popular_score = models.IntegerField(
+        'Популярность',
+        default=0, editable=False
+    )
+    trending_score = models.FloatField(
+        'Рейтинг в трендах',
+        default=0, editable=False
+    )
+    search_vector = SearchVectorField(
+        'Поисковый индекс',
+        null=True, editable=False
+    )
+    image_renditions = models.TextField(
+        'Уменьшенные копии картинки',
+        blank=True, default='', editable=False
+    )
 
     class Meta:
         ordering = ['-created']
+        indexes = [
+            models.Index(
+                fields=['-created', '-id'],
+                name='recipe_created_idx'
+            ),
+            models.Index(
+                fields=['-popular_score', '-id'],
+                name='recipe_popular_idx'
+            ),
+            models.Index(
+                fields=['-trending_score', '-id'],
+                name='recipe_trending_idx'
+            ),
+        ]
         verbose_name = 'рецепт'
         verbose_name_plural = 'Рецепты'
 
@@ -101,7 +146,15 @@ class Recipe(models.Model):
         return ',\n'.join([i.name for i in self.tags.all()])
 
     def count_favorite(self):
-        return Favorite.objects.filter(recipe=self.pk).count()
+        return self.favorites_count
+
+    def get_renditions(self):
+        if not self.image_renditions:
+            return {}
+        renditions = json.loads(self.image_renditions)
+        if renditions.get('source') != self.image.name:
+            return {}
+        return renditions['renditions']
 
     get_ingredients.short_description = 'Ингредиенты'
     get_tags.short_description = 'Тэги'
@@ -154,6 +207,10 @@ class Favorite(models.Model):
         related_name='recipe',
         verbose_name='Рецепт'
     )
+    created = models.DateTimeField(
+        'Дата добавления',
+        auto_now_add=True, db_index=True
+    )
 
     class Meta:
         ordering = ['pk']
@@ -178,8 +235,107 @@ class ShoppingCart(models.Model):
         related_name='shoppingrecipe',
         verbose_name='Рецепт для покупок'
     )
+    created = models.DateTimeField(
+        'Дата добавления',
+        auto_now_add=True, db_index=True
+    )
 
     class Meta:
         ordering = ['pk']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_shopping_cart'
+            )
+        ]
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Списки покупок'
+
+
+class ShoppingListItemManager(models.Manager):
+    def compute(self):
+        return IngredientAmount.objects.filter(
+            recipe__shoppingrecipe__isnull=False
+        ).values(
+            'recipe__shoppingrecipe__user', 'ingredient'
+        ).order_by().annotate(total_amount=Sum('amount'))
+
+    def apply(self, user_ids, amounts):
+        user_ids = list(user_ids)
+        amounts = {
+            ingredient_id: amount
+            for ingredient_id, amount in amounts.items() if amount
+        }
+        if not user_ids or not amounts:
+            return
+        with transaction.atomic():
+            # Недостающие строки вставляются с нулём, а количество
+            # прибавляется одним UPDATE, поэтому параллельные запросы
+            # не нарушают unique_shopping_list_item.
+            self.bulk_create([
+                self.model(user_id=user_id, ingredient_id=ingredient_id)
+                for user_id in user_ids
+                for ingredient_id, amount in amounts.items()
+                if amount > 0
+            ], ignore_conflicts=True)
+            self.filter(
+                user_id__in=user_ids,
+                ingredient_id__in=amounts
+            ).update(amount=F('amount') + Case(
+                *[When(ingredient_id=ingredient_id, then=Value(amount))
+                  for ingredient_id, amount in amounts.items()],
+                output_field=models.IntegerField()
+            ))
+            self.filter(user_id__in=user_ids, amount__lte=0).delete()
+
+    def recipe_amounts(self, recipe_id):
+        return dict(IngredientAmount.objects.filter(
+            recipe_id=recipe_id
+        ).values_list('ingredient_id', 'amount'))
+
+    def add_recipe(self, user_ids, recipe_id):
+        self.apply(user_ids, self.recipe_amounts(recipe_id))
+
+    def remove_recipe(self, user_ids, recipe_id):
+        self.apply(user_ids, {
+            ingredient_id: -amount
+            for ingredient_id, amount
+            in self.recipe_amounts(recipe_id).items()
+        })
+
+    def change_recipe(self, recipe_id, old_amounts, new_amounts):
+        user_ids = ShoppingCart.objects.filter(
+            recipe_id=recipe_id
+        ).values_list('user_id', flat=True)
+        self.apply(user_ids, {
+            ingredient_id: (new_amounts.get(ingredient_id, 0)
+                            - old_amounts.get(ingredient_id, 0))
+            for ingredient_id in {*old_amounts, *new_amounts}
+        })
+
+
+class ShoppingListItem(models.Model):
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Покупатель'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient, on_delete=models.CASCADE,
+        related_name='shopping_list_items',
+        verbose_name='Ингредиент'
+    )
+    amount = models.IntegerField(verbose_name='Количество', default=0)
+
+    objects = ShoppingListItemManager()
+
+    class Meta:
+        ordering = ['pk']
+        verbose_name = 'Ингредиент списка покупок'
+        verbose_name_plural = 'Ингредиенты списков покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_shopping_list_item'
+            )
+        ]
@@ -0,0 +1,126 @@
+import re
+from collections import defaultdict
+
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connections
+from django.db.models import F, FloatField, TextField, Value
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'russian'
+SEARCH_FTS_TABLE = 'recipes_recipe_fts'
+SEARCH_INDEX = 'recipes_recipe_search_vector_gin'
+SEARCH_BATCH_SIZE = 500
+SEARCH_RANK = 'search_rank'
+
+
+def create_search_index(schema_editor):
+    # На PostgreSQL поиск идёт по столбцу search_vector с GIN-индексом,
+    # на SQLite (локальная разработка) - по виртуальной таблице FTS5.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f'CREATE INDEX {SEARCH_INDEX} ON recipes_recipe '
+            'USING gin (search_vector);'
+        )
+    elif schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {SEARCH_FTS_TABLE} '
+            'USING fts5(name, ingredients, text);'
+        )
+
+
+def drop_search_index(schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX {SEARCH_INDEX};')
+    elif schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE {SEARCH_FTS_TABLE};')
+
+
+def get_documents(recipes):
+    ingredients = defaultdict(list)
+    for recipe_id, name in recipes.values_list(
+        'id', 'recipe_amount__ingredient__name'
+    ).order_by('id', 'recipe_amount__ingredient__name'):
+        if name:
+            ingredients[recipe_id].append(name)
+    return [
+        (recipe_id, name or '', ' '.join(ingredients[recipe_id]), text or '')
+        for recipe_id, name, text in recipes.values_list(
+            'id', 'name', 'text'
+        ).order_by('id')
+    ]
+
+
+def document_vector(name, ingredients, text):
+    return (
+        SearchVector(Value(name, output_field=TextField()),
+                     config=SEARCH_CONFIG, weight='A')
+        + SearchVector(Value(ingredients, output_field=TextField()),
+                       config=SEARCH_CONFIG, weight='B')
+        + SearchVector(Value(text, output_field=TextField()),
+                       config=SEARCH_CONFIG, weight='C')
+    )
+
+
+def update_search_index(recipe_model, recipe_ids=None):
+    """Пересчитывает поисковый индекс рецептов (всех, если ids не заданы)."""
+    recipes = recipe_model.objects.all()
+    if recipe_ids is not None:
+        recipes = recipes.filter(id__in=recipe_ids)
+    connection = connections[recipes.db]
+    documents = get_documents(recipes)
+    if connection.vendor == 'postgresql':
+        recipe_model.objects.bulk_update(
+            [
+                recipe_model(id=recipe_id, search_vector=document_vector(
+                    name, ingredients, text
+                ))
+                for recipe_id, name, ingredients, text in documents
+            ],
+            ['search_vector'],
+            batch_size=SEARCH_BATCH_SIZE
+        )
+    elif connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            if recipe_ids is None:
+                cursor.execute(f'DELETE FROM {SEARCH_FTS_TABLE}')
+            else:
+                cursor.executemany(
+                    f'DELETE FROM {SEARCH_FTS_TABLE} WHERE rowid = %s',
+                    [(recipe_id,) for recipe_id in recipe_ids]
+                )
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_FTS_TABLE} '
+                '(rowid, name, ingredients, text) VALUES (%s, %s, %s, %s)',
+                documents
+            )
+
+
+def search_recipes(queryset, query):
+    """Фильтрует рецепты по запросу и сортирует по релевантности."""
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        return queryset.annotate(**{
+            SEARCH_RANK: SearchRank(F('search_vector'), search_query)
+        }).filter(search_vector=search_query).order_by(f'-{SEARCH_RANK}',
+                                                       '-id')
+    if connection.vendor != 'sqlite':
+        return queryset.filter(name__icontains=query)
+    # В FTS5 нет русской морфологии, поэтому слова ищутся по префиксу.
+    words = re.findall(r'\w+', query)
+    if not words:
+        return queryset.none()
+    match = ' '.join(f'"{word}"*' for word in words)
+    table = queryset.model._meta.db_table
+    return queryset.extra(
+        where=[f'{table}.id IN (SELECT rowid FROM {SEARCH_FTS_TABLE} '
+               f'WHERE {SEARCH_FTS_TABLE} MATCH %s)'],
+        params=[match]
+    ).annotate(**{SEARCH_RANK: RawSQL(
+        f'SELECT -bm25({SEARCH_FTS_TABLE}, 10.0, 4.0, 1.0) '
+        f'FROM {SEARCH_FTS_TABLE} WHERE {SEARCH_FTS_TABLE} MATCH %s '
+        f'AND rowid = {table}.id',
+        (match,),
+        output_field=FloatField()
+    )}).order_by(f'-{SEARCH_RANK}', '-id')
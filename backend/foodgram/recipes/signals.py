@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Копии картинки рецепта сохраняются через QuerySet.update(),
+# а ингредиенты импортируются через bulk_create/bulk_update:
+# post_save в обоих случаях не срабатывает.
+renditions_ready = Signal(providing_args=['recipe_id'])
+ingredients_imported = Signal(providing_args=['updated_ids', 'inserted'])
@@ -0,0 +1,47 @@
+import os
+from hashlib import sha256
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+CONTENT_DIRECTORY = 'cas'
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Хранилище, в котором имя файла - SHA-256 его содержимого.
+
+    Одинаковые файлы сохраняются один раз, а файлы раскладываются
+    по двум уровням подкаталогов, чтобы каталоги не разрастались.
+    Неиспользуемые файлы удаляет команда collect_images.
+    """
+
+    def get_content_name(self, name, content):
+        digest = sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return (f'{CONTENT_DIRECTORY}/{digest[:2]}/{digest[2:4]}/'
+                f'{digest}{extension}')
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            # Файл используется снова: обновляем время изменения, чтобы
+            # collect_images не удалил его по --min-age до коммита.
+            try:
+                os.utime(self.path(name))
+                return name
+            except FileNotFoundError:
+                pass
+        return self._save(name, content)
+
+
+content_storage = ContentAddressedStorage()
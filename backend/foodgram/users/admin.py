@@ -4,7 +4,8 @@ from .models import Follow, User
 
 
 class UserAdmin(admin.ModelAdmin):
-    list_display = ('username', 'email', 'first_name', 'last_name', 'role')
+    list_display = ('username', 'email', 'first_name', 'last_name', 'role',
+                    'recipes_count', 'followers_count')
     list_filter = ('username', 'email',)
     empty_value_display = '-пусто-'
 
@@ -21,6 +21,14 @@ class User(AbstractUser):
     first_name = models.CharField(max_length=150, blank=False)
     last_name = models.CharField(max_length=150, blank=False)
     role = models.TextField(choices=CHOICES, default=user)
+    recipes_count = models.IntegerField(
+        'Количество рецептов',
+        default=0, editable=False
+    )
+    followers_count = models.IntegerField(
+        'Количество подписчиков',
+        default=0, editable=False
+    )
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']